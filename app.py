@@ -2,28 +2,108 @@
 
 This file provides a web interface with routes for rendering the home page, recommending books 
 based on user input, and displaying top books. 
-The application loads preprocessed data, including top 50 books and recommendation datasets, 
+The application loads the preprocessed artifacts, including top 50 books and recommendation datasets, 
 and utilizes the RecommendationSystem to offer book recommendations by book title, author, 
 publisher, year, and location. 
-The 'home.html' and 'searchBooks.html' templates are used for rendering the web pages.
+The 'home.html' and 'searchBooks.html' templates are used for rendering the web pages,
+and '/api/recommend' returns the same recommendations as compact JSON.
+'/api/autocomplete' suggests titles, authors, publishers and locations while typing.
+'/api/search' combines author, publisher, country and year range filters, one page at a time.
+'/metrics' exposes request, strategy and rendering timings in the Prometheus format.
+The COLLABORATIVE_ENGINE environment variable selects the similar-books engine,
+"cosine" (the default) or "embedding". The server follows the artifact version
+published in artifacts/CURRENT, checking every ARTIFACT_POLL_SECONDS seconds,
+and swaps it in without dropping requests; every request is answered from the
+snapshot that was live when it started.
+
+create_app builds the application. By default artifacts are loaded when a
+request first needs them, so a worker starts at once. Under a pre-forking
+server, preload them once in the master and fork the workers afterwards:
+    gunicorn --preload --workers 8 "app:create_app(preload=True)"
+The artifacts are memory-mapped, and the titles, authors, covers and places
+served for every book are decoded from them per request, so the workers share
+those pages. Python objects built at load time, such as the lookup dicts of the
+indexes, are still copied into a worker page by page as reference counts on
+them change; freezing them out of the garbage collector before the fork only
+keeps collections from copying them all at once. asgi.py serves the same
+application from an asyncio server, sharing one computation among identical
+concurrent requests.
 
 """
-import pickle
+import gc
 import json
-from flask import Flask, render_template, request
+import os
+
+from flask import Blueprint, Flask, current_app, render_template, request
 
+from autocomplete import SUGGESTIONS_COUNT
+from facets import FACET_PAGE_SIZE
+from artifact_store import ARTIFACTS_DIR
+from metrics import MetricsRegistry
 from recommendations import RecommendationSystem
+from snapshots import POLL_INTERVAL, SnapshotManager
+
+routes = Blueprint("recommendations", __name__)
+
+
+def create_app(artifacts_dir=ARTIFACTS_DIR, preload=False, watch=True):
+    """Build the application serving the published artifact version.
+
+    ``preload`` loads every artifact now and freezes the heap, for a
+    pre-forking server; ``watch`` follows newly published versions.
+    """
+    app = Flask(__name__)
+    app_metrics = MetricsRegistry()
+    snapshots = SnapshotManager(
+        lambda: RecommendationSystem(
+            artifacts_dir,
+            parallel=True,
+            collaborative_engine=os.environ.get("COLLABORATIVE_ENGINE", "cosine"),
+            metrics=app_metrics,
+        ),
+        artifacts_dir,
+        app_metrics,
+    )
+    snapshots.load(preload=preload)
+    if watch:
+        snapshots.watch(float(os.environ.get("ARTIFACT_POLL_SECONDS", POLL_INTERVAL)))
+
+    app.extensions["recommendations"] = {
+        "snapshots": snapshots,
+        "metrics": app_metrics,
+        "render_seconds": app_metrics.histogram(
+            "template_render_seconds",
+            "Time to render each page template.",
+            ["template"],
+        ),
+    }
+    app.register_blueprint(routes)
+    if preload:
+        # Collections in the workers skip the objects that survive the fork;
+        # their pages are copied only as requests change reference counts
+        gc.collect()
+        gc.freeze()
+    return app
+
+
+def extension(name):
+    return current_app.extensions["recommendations"][name]
+
+
+def live_system():
+    """The snapshot to answer the current request from; read it once."""
+    return extension("snapshots").current
+
 
-recommendation_obj = RecommendationSystem()
-with open("pklFiles/top_50_books.pkl", "rb") as file:
-    top_50_books = pickle.load(file)
-recommendation_obj.load_data()
-app = Flask(__name__)
+def render(template_name, **context):
+    with extension("render_seconds").time(template_name):
+        return render_template(template_name, **context)
 
 
-@app.route("/")
+@routes.route("/")
 def index():
-    return render_template(
+    top_50_books = live_system().df_top_books
+    return render(
         "home.html",
         book_name=list(top_50_books["Book-Title"].values),
         book_author=list(top_50_books["Book-Author"].values),
@@ -31,43 +111,159 @@ def index():
     )
 
 
-@app.route("/recommend")
+@routes.route("/recommend")
 def recommend_ui():
-    return render_template("searchBooks.html")
+    return render("searchBooks.html")
 
 
-@app.route("/recommend_books", methods=["post"])
-def recommend():
-    user_input = request.form.get("user-input")
-    option_selection = request.form.get("searchBy")
-    if len(str(user_input)) == 0:
-        return render_template("searchBooks.html")
-    final_results = []
+SEARCH_TYPES = ("bookname", "author", "publisher", "year", "location")
+MAX_BATCH_SIZE = 10000
+MAX_SUGGESTIONS = 50
+MAX_SEARCH_PAGE = 100
 
+
+def get_recommendations(recommendation_obj, option_selection, user_input, timings=None):
+    """Return the recommendation lists for one search type and input."""
     match option_selection:
         case "bookname":
-            final_results = json.loads(
-                recommendation_obj.get_recommendations_by_book(user_input)
-            )
+            return recommendation_obj.get_recommendations_by_book(user_input, timings)
         case "author":
-            final_results = json.loads(
-                recommendation_obj.get_recommendations_by_author(user_input)
-            )
+            return recommendation_obj.get_recommendations_by_author(user_input)
         case "publisher":
-            final_results = json.loads(
-                recommendation_obj.get_recommendations_by_publisher(user_input)
-            )
+            return recommendation_obj.get_recommendations_by_publisher(user_input)
         case "year":
-            final_results = json.loads(
-                recommendation_obj.get_recommendations_by_year(user_input)
-            )
-
+            return recommendation_obj.get_recommendations_by_year(user_input)
         case "location":
-            final_results = json.loads(
-                recommendation_obj.get_recommendations_by_location(user_input)
-            )
-    return render_template("searchBooks.html", bookList=final_results)
+            return recommendation_obj.get_recommendations_by_location(user_input)
+    return []
+
+
+@routes.route("/recommend_books", methods=["post"])
+def recommend():
+    user_input = request.form.get("user-input")
+    option_selection = request.form.get("searchBy")
+    if len(str(user_input)) == 0:
+        return render("searchBooks.html")
+    timings = {}
+
+    final_results = (
+        get_recommendations(live_system(), option_selection, user_input, timings) or []
+    )
+    response = current_app.make_response(
+        render("searchBooks.html", bookList=final_results)
+    )
+    if timings:
+        response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+
+@routes.route("/api/recommend", methods=["get", "post"])
+def recommend_api():
+    user_input = request.values.get("user-input", "")
+    option_selection = request.values.get("searchBy", "bookname")
+    if len(user_input) == 0:
+        return current_app.response_class("[]", mimetype="application/json")
+
+    if option_selection not in SEARCH_TYPES:
+        return current_app.response_class(
+            '{"error":"unknown searchBy"}', status=400, mimetype="application/json"
+        )
+
+    recommendation_obj = live_system()
+    final_results = (
+        get_recommendations(recommendation_obj, option_selection, user_input) or []
+    )
+    return current_app.response_class(
+        recommendation_obj.results_in_json(final_results),
+        mimetype="application/json",
+    )
+
+
+@routes.route("/api/autocomplete")
+def autocomplete_api():
+    prefix = request.args.get("user-input", "")
+    option_selection = request.args.get("searchBy", "bookname")
+    if option_selection not in SEARCH_TYPES:
+        return current_app.response_class(
+            '{"error":"unknown searchBy"}', status=400, mimetype="application/json"
+        )
+
+    limit = request.args.get("limit", SUGGESTIONS_COUNT, type=int)
+    suggestions = live_system().suggestions(
+        option_selection, prefix, min(max(limit, 1), MAX_SUGGESTIONS)
+    )
+    return current_app.response_class(
+        json.dumps(suggestions, separators=(",", ":")), mimetype="application/json"
+    )
+
+
+@routes.route("/api/recommend/batch", methods=["post"])
+def recommend_batch_api():
+    payload = request.get_json(silent=True) or {}
+    book_names = payload.get("titles")
+    if not isinstance(book_names, list):
+        return current_app.response_class(
+            '{"error":"expected a JSON body with a titles list"}',
+            status=400,
+            mimetype="application/json",
+        )
+    if len(book_names) > MAX_BATCH_SIZE:
+        return current_app.response_class(
+            f'{{"error":"at most {MAX_BATCH_SIZE} titles per batch"}}',
+            status=413,
+            mimetype="application/json",
+        )
+
+    recommendation_obj = live_system()
+    final_results = recommendation_obj.get_recommendations_by_books(book_names)
+    return current_app.response_class(
+        recommendation_obj.results_in_json(
+            [
+                {"input": book_name, "recommendations": recommendations}
+                for book_name, recommendations in zip(book_names, final_results)
+            ]
+        ),
+        mimetype="application/json",
+    )
+
+
+@routes.route("/api/search")
+def search_api():
+    limit = request.args.get("limit", FACET_PAGE_SIZE, type=int)
+    recommendation_obj = live_system()
+    page, total = recommendation_obj.search_books(
+        author=request.args.get("author") or None,
+        publisher=request.args.get("publisher") or None,
+        country=request.args.get("country") or None,
+        year_from=request.args.get("year_from", type=int),
+        year_to=request.args.get("year_to", type=int),
+        offset=max(request.args.get("offset", 0, type=int), 0),
+        limit=min(max(limit, 1), MAX_SEARCH_PAGE),
+    )
+    return current_app.response_class(
+        recommendation_obj.results_in_json({"total": total, "results": page}),
+        mimetype="application/json",
+    )
+
+
+@routes.route("/metrics")
+def metrics():
+    return current_app.response_class(
+        extension("metrics").render(),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+def server_timing(timings):
+    """Format per-strategy seconds as a Server-Timing header value."""
+    metrics = []
+    for name, elapsed in timings.items():
+        if elapsed is None:
+            metrics.append(f'{name};desc="timed out"')
+        else:
+            metrics.append(f"{name};dur={elapsed * 1000:.2f}")
+    return ", ".join(metrics)
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
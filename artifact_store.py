@@ -0,0 +1,272 @@
+"""
+
+This file contains the columnar artifact format shared by the preprocessing step
+and the web server. Every artifact version is a directory of .npy files plus a
+manifest.json describing them; the server opens the files memory-mapped and
+read-only, so startup does not deserialise anything and all workers on a host
+share the same page cache.
+
+Numeric columns are stored as plain arrays. String columns are dictionary
+encoded: integer codes plus the distinct values packed as one UTF-8 buffer and
+an offsets array.
+
+The served indexes (titles, prefixes, facets, leaderboards, nearest neighbours
+and embeddings) are stored the same way, as flat arrays the server can
+memory-map; their lists of book ids are concatenated behind an offsets array.
+
+The CURRENT file names the live version. Older versions stay on disk, so
+pointing CURRENT back at one of them rolls the servers back:
+    python artifact_store.py --rollback
+
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+ARTIFACTS_DIR = "artifacts"
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+
+def current_version(root=ARTIFACTS_DIR):
+    with open(os.path.join(root, CURRENT_FILE)) as file:
+        return file.read().strip()
+
+
+def publish_version(root, version):
+    """Atomically point CURRENT at a committed version."""
+    current_path = os.path.join(root, CURRENT_FILE)
+    with open(f"{current_path}.tmp", "w") as file:
+        file.write(version)
+    os.replace(f"{current_path}.tmp", current_path)
+
+
+def committed_versions(root=ARTIFACTS_DIR):
+    """Return the versions with a manifest, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        version
+        for version in os.listdir(root)
+        if os.path.isfile(os.path.join(root, version, MANIFEST_FILE))
+    )
+
+
+def slice_offsets(lengths):
+    """Offsets of consecutive slices of the given lengths; slice i of the
+    concatenation is offsets[i]:offsets[i + 1]."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class StringArray:
+    """Read-only sequence of strings backed by a UTF-8 buffer and offsets."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return bytes(self.data[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def to_list(self):
+        buffer = bytes(self.data)
+        offsets = self.offsets.tolist()
+        return [
+            buffer[start:end].decode("utf-8")
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    @staticmethod
+    def encode(values):
+        encoded = [str(value).encode("utf-8") for value in values]
+        offsets = slice_offsets([len(value) for value in encoded])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return offsets, data
+
+
+class StringColumn:
+    """Read-only string column of a table: codes into its distinct values.
+
+    Values are decoded from the memory-mapped buffers when read, so no Python
+    string outlives the request that reads it; a missing value is None.
+    """
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, positions):
+        codes = self.codes[positions]
+        if np.ndim(codes) == 0:
+            return self.value(codes)
+        return [self.value(code) for code in codes.tolist()]
+
+    def value(self, code):
+        return None if code < 0 else self.categories[code]
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.empty(0, dtype=np.int8),
+            StringArray(np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.uint8)),
+        )
+
+
+class ArtifactWriter:
+    """Write one artifact version; it only becomes visible once committed."""
+
+    def __init__(self, root=ARTIFACTS_DIR, version=None):
+        self.root = root
+        self.version = version or datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.directory = os.path.join(root, self.version)
+        self.manifest = {"version": self.version, "arrays": {}, "tables": {}}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def save(self, filename, array):
+        np.save(os.path.join(self.directory, filename), np.ascontiguousarray(array))
+        return filename
+
+    def write_array(self, name, array):
+        self.manifest["arrays"][name] = {
+            "kind": "numeric",
+            "file": self.save(f"{name}.npy", array),
+        }
+
+    def write_strings(self, name, values):
+        offsets, data = StringArray.encode(values)
+        self.manifest["arrays"][name] = {
+            "kind": "strings",
+            "offsets": self.save(f"{name}.offsets.npy", offsets),
+            "data": self.save(f"{name}.data.npy", data),
+        }
+
+    def write_table(self, name, dataframe):
+        columns = []
+        for position, column in enumerate(dataframe.columns):
+            prefix = f"{name}.{position}"
+            values = dataframe[column]
+            if pd.api.types.is_numeric_dtype(values) and not isinstance(
+                values.dtype, pd.CategoricalDtype
+            ):
+                columns.append(
+                    {
+                        "name": column,
+                        "kind": "numeric",
+                        "file": self.save(f"{prefix}.npy", values.to_numpy()),
+                    }
+                )
+                continue
+
+            categorical = pd.Categorical(values).remove_unused_categories()
+            offsets, data = StringArray.encode(categorical.categories)
+            columns.append(
+                {
+                    "name": column,
+                    "kind": "categorical",
+                    "codes": self.save(f"{prefix}.codes.npy", categorical.codes),
+                    "offsets": self.save(f"{prefix}.offsets.npy", offsets),
+                    "data": self.save(f"{prefix}.data.npy", data),
+                }
+            )
+        self.manifest["tables"][name] = {"rows": len(dataframe), "columns": columns}
+
+    def commit(self):
+        """Write the manifest and point CURRENT at this version."""
+        with open(os.path.join(self.directory, MANIFEST_FILE), "w") as file:
+            json.dump(self.manifest, file, indent=4)
+        publish_version(self.root, self.version)
+        return self.version
+
+
+class ArtifactStore:
+    """Memory-mapped, read-only view of one artifact version."""
+
+    def __init__(self, root=ARTIFACTS_DIR, version=None):
+        if version is None:
+            version = current_version(root)
+        self.version = version
+        self.directory = os.path.join(root, version)
+        with open(os.path.join(self.directory, MANIFEST_FILE)) as file:
+            self.manifest = json.load(file)
+
+    def load(self, filename):
+        return np.load(os.path.join(self.directory, filename), mmap_mode="r")
+
+    def array(self, name):
+        entry = self.manifest["arrays"][name]
+        if entry["kind"] == "strings":
+            return StringArray(self.load(entry["offsets"]), self.load(entry["data"]))
+        return self.load(entry["file"])
+
+    def string_column(self, table, name):
+        """One string column of a table, left memory-mapped."""
+        for column in self.manifest["tables"][table]["columns"]:
+            if column["name"] == name and column["kind"] == "categorical":
+                return StringColumn(
+                    self.load(column["codes"]),
+                    StringArray(
+                        self.load(column["offsets"]), self.load(column["data"])
+                    ),
+                )
+        raise KeyError(f"{table} has no string column {name}")
+
+    def table(self, name):
+        columns = {}
+        for column in self.manifest["tables"][name]["columns"]:
+            if column["kind"] == "numeric":
+                values = self.load(column["file"])
+            else:
+                categories = StringArray(
+                    self.load(column["offsets"]), self.load(column["data"])
+                )
+                values = pd.Categorical.from_codes(
+                    self.load(column["codes"]), categories=categories.to_list()
+                )
+            columns[column["name"]] = pd.Series(values, copy=False)
+        return pd.DataFrame(columns, copy=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the artifact versions.")
+    parser.add_argument("--root", default=ARTIFACTS_DIR)
+    actions = parser.add_mutually_exclusive_group()
+    actions.add_argument("--publish", metavar="VERSION", help="make VERSION live")
+    actions.add_argument(
+        "--rollback",
+        action="store_true",
+        help="make the version committed before the live one live again",
+    )
+    arguments = parser.parse_args()
+
+    versions = committed_versions(arguments.root)
+    if arguments.publish:
+        if arguments.publish not in versions:
+            parser.error(f"unknown version {arguments.publish}")
+        publish_version(arguments.root, arguments.publish)
+    elif arguments.rollback:
+        live = current_version(arguments.root)
+        older = [version for version in versions if version < live]
+        if not older:
+            parser.error(f"no version older than {live}")
+        publish_version(arguments.root, older[-1])
+
+    live = current_version(arguments.root)
+    for version in versions:
+        marker = "*" if version == live else " "
+        print(f"{marker} {version}")
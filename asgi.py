@@ -0,0 +1,236 @@
+"""
+
+This file provides an ASGI application serving the web application from an
+asyncio server, for example:
+    uvicorn --factory "asgi:create_asgi_app" --workers 4
+Requests are answered by the Flask application on a bounded pool of threads,
+so the event loop only reads requests and writes responses. Identical
+recommendation requests arriving while one is being answered (same route,
+search type, input and artifact version) wait for that answer instead of
+computing it again, so a burst of searches for a featured title costs one
+computation. When every thread is busy and MAX_PENDING requests are already
+queued, further requests are turned away with 503.
+
+MAX_CONCURRENCY and MAX_PENDING can be set through environment variables of
+the same names.
+
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from app import create_app
+
+MAX_CONCURRENCY = 8
+MAX_PENDING = 256
+# Routes whose concurrent identical requests share one response, with the
+# search type a request without one gets
+COALESCED_ROUTES = {"/recommend_books": None, "/api/recommend": "bookname"}
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+BUSY_RESPONSE = (
+    503,
+    [(b"content-type", b"text/plain; charset=utf-8"), (b"retry-after", b"1")],
+    b"Too many requests in progress\n",
+)
+
+
+def first_values(pairs):
+    """Keep the first value of every field, as Flask's request.values.get does."""
+    values = {}
+    for name, value in pairs:
+        values.setdefault(name, value)
+    return values
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+class CoalescingServer:
+    def __init__(
+        self, flask_app, max_concurrency=MAX_CONCURRENCY, max_pending=MAX_PENDING
+    ):
+        self.flask_app = flask_app
+        self.snapshots = flask_app.extensions["recommendations"]["snapshots"]
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(
+            max_concurrency, thread_name_prefix="asgi-request"
+        )
+        # Only touched from the event loop, so they need no lock
+        self.outstanding = 0
+        self.in_flight = {}
+        metrics = flask_app.extensions["recommendations"]["metrics"]
+        self.coalesced = metrics.counter(
+            "recommendation_coalesced_requests_total",
+            "Requests answered with the response of an identical request.",
+            ["route"],
+        )
+        self.rejected = metrics.counter(
+            "recommendation_rejected_requests_total",
+            "Requests turned away because too many were waiting.",
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        body = await read_body(receive)
+        key = self.coalescing_key(scope, body)
+        if key is None:
+            response = await self.respond(scope, body)
+        else:
+            response = await self.single_flight(key, scope, body)
+
+        status, headers, content = response
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": content})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def close(self):
+        self.snapshots.stop()
+        self.executor.shutdown(wait=False)
+
+    def coalescing_key(self, scope, body):
+        """Identify requests answered alike, or None for one never shared."""
+        route = scope["path"]
+        if route not in COALESCED_ROUTES or scope["method"] not in ("GET", "POST"):
+            return None
+
+        headers = dict(scope["headers"])
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        if body and not content_type.startswith(FORM_CONTENT_TYPE):
+            return None
+        form = parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True)
+        if route == "/recommend_books":
+            values = first_values(form)
+        else:
+            query = parse_qsl(
+                scope["query_string"].decode("latin-1"), keep_blank_values=True
+            )
+            values = first_values(query + form)
+        return (
+            route,
+            scope["method"],
+            self.snapshots.current.artifact_version,
+            values.get("searchBy", COALESCED_ROUTES[route]),
+            values.get("user-input"),
+        )
+
+    async def single_flight(self, key, scope, body):
+        """Share one response among concurrent requests with the same key."""
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.respond(scope, body))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced.inc(key[0])
+        # A request that goes away must not cancel the others' response
+        return await asyncio.shield(task)
+
+    async def respond(self, scope, body):
+        if self.outstanding >= self.max_concurrency + self.max_pending:
+            self.rejected.inc()
+            return BUSY_RESPONSE
+        self.outstanding += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.call_flask, self.wsgi_environ(scope, body)
+            )
+        finally:
+            self.outstanding -= 1
+
+    def call_flask(self, environ):
+        """Run the Flask application on a WSGI environ; returns an ASGI response."""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"], started["headers"] = status, headers
+
+        chunks = self.flask_app(environ, start_response)
+        try:
+            content = b"".join(chunks)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return (
+            int(started["status"].split(" ", 1)[0]),
+            [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in started["headers"]
+            ],
+            content,
+        )
+
+    @staticmethod
+    def wsgi_environ(scope, body):
+        root_path = scope.get("root_path", "")
+        path = scope["path"]
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        server_name, server_port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            # WSGI carries paths as UTF-8 bytes decoded as latin-1
+            "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+            "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": (scope.get("client") or ("",))[0],
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_LENGTH":
+                continue
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+                continue
+            name = f"HTTP_{name}"
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+        return environ
+
+
+def create_asgi_app(preload=False, watch=True):
+    """Build the ASGI application; see create_app for the arguments."""
+    return CoalescingServer(
+        create_app(preload=preload, watch=watch),
+        int(os.environ.get("MAX_CONCURRENCY", MAX_CONCURRENCY)),
+        int(os.environ.get("MAX_PENDING", MAX_PENDING)),
+    )
@@ -0,0 +1,152 @@
+"""
+
+This file contains a PrefixIndex class that suggests completions for what a
+user is typing, such as titles, authors, publishers or locations. Every value
+is normalised like the title index and indexed at the start of each of its
+words, so "pott" completes "Harry Potter". The word starts are kept sorted by
+the text that follows them: the words starting with a prefix form one
+contiguous range found by two binary searches, and the heaviest values in that
+range (for example by aggregated rating) are suggested first.
+
+Normalising the values and sorting their word starts does not depend on the
+weights, so a Vocabulary does it once for a fixed set of values and ranks any
+of them by new weights without sorting text again.
+
+"""
+import numpy as np
+import pandas as pd
+
+from search_index import TitleIndex
+
+SUGGESTIONS_COUNT = 10
+
+
+class PrefixIndex:
+    def __init__(self, values, keys, word_values, word_starts):
+        self.values = values
+        self.keys = keys
+        self.word_values = word_values
+        self.word_starts = word_starts
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def build(cls, values, weights):
+        """Index values, ranked by weight; values normalising alike are merged."""
+        return Vocabulary(values).rank(np.arange(len(values)), weights)
+
+    @classmethod
+    def from_store(cls, store, name):
+        return cls(
+            store.array(f"{name}.values"),
+            store.array(f"{name}.keys"),
+            store.array(f"{name}.word_values"),
+            store.array(f"{name}.word_starts"),
+        )
+
+    def write(self, writer, name):
+        writer.write_strings(f"{name}.values", self.values)
+        writer.write_strings(f"{name}.keys", self.keys)
+        writer.write_array(f"{name}.word_values", self.word_values)
+        writer.write_array(f"{name}.word_starts", self.word_starts)
+
+    def word_prefix(self, position, length):
+        start = self.word_starts[position]
+        return self.keys[self.word_values[position]][start : start + length]
+
+    def bound(self, prefix, inclusive):
+        """First word start whose text is above (or, inclusive, at) the prefix."""
+        low, high = 0, len(self.word_values)
+        while low < high:
+            middle = (low + high) // 2
+            text = self.word_prefix(middle, len(prefix))
+            if text < prefix or inclusive and text == prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def suggest(self, prefix, limit=SUGGESTIONS_COUNT):
+        """Return up to limit values with a word starting with prefix, heaviest first."""
+        prefix = TitleIndex.normalise(prefix)
+        if not prefix or limit <= 0:
+            return []
+
+        start, end = self.bound(prefix, False), self.bound(prefix, True)
+        # Values are stored heaviest first, so the smallest ids rank highest.
+        # A value matching at several words repeats, so widen the partition
+        # until it holds enough distinct ids.
+        matches = self.word_values[start:end]
+        taken = limit
+        while True:
+            if taken >= len(matches):
+                value_ids = np.unique(matches)
+                break
+            value_ids = np.unique(np.partition(matches, taken - 1)[:taken])
+            if len(value_ids) >= limit:
+                break
+            taken *= 4
+        return [self.values[value_id] for value_id in value_ids[:limit]]
+
+
+class Vocabulary:
+    def __init__(self, values):
+        """Normalise values and sort the word starts of their distinct keys."""
+        self.values = [str(value) for value in values]
+        value_keys, keys = pd.factorize(
+            pd.Series(self.values, dtype=object).map(TitleIndex.normalise),
+            sort=True,
+        )
+        self.value_keys = value_keys.astype(np.int32)
+        self.keys = keys.tolist()
+
+        word_keys, word_starts, suffixes = [], [], []
+        for key_id, key in enumerate(self.keys):
+            for start in range(len(key)):
+                if start == 0 or key[start - 1] == " ":
+                    word_keys.append(key_id)
+                    word_starts.append(start)
+                    suffixes.append(key[start:])
+        suffixes = np.array(suffixes, dtype=object)
+        order = np.argsort(suffixes, kind="stable")
+        suffixes = suffixes[order]
+        self.word_keys = np.array(word_keys, dtype=np.int32)[order]
+        self.word_starts = np.array(word_starts, dtype=np.int32)[order]
+        # Word starts followed by the same text share a group
+        self.word_groups = np.cumsum(
+            np.append(True, suffixes[1:] != suffixes[:-1]), dtype=np.int32
+        )
+
+    def __len__(self):
+        return len(self.values)
+
+    def rank(self, value_ids, weights):
+        """Return the PrefixIndex of the values at ``value_ids``, ranked by weight.
+
+        Values normalising alike are merged into the heaviest, earlier ones
+        winning ties, exactly as PrefixIndex.build does.
+        """
+        value_ids = np.asarray(value_ids, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float32)
+        value_ids = value_ids[np.argsort(-weights, kind="stable")]
+        value_keys = self.value_keys[value_ids]
+        _, first_positions = np.unique(value_keys, return_index=True)
+        first_positions = np.sort(first_positions)
+        value_ids, value_keys = value_ids[first_positions], value_keys[first_positions]
+        if len(self.keys) and self.keys[0] == "":
+            is_named = value_keys != 0
+            value_ids, value_keys = value_ids[is_named], value_keys[is_named]
+
+        key_values = np.full(len(self.keys), -1, dtype=np.int64)
+        key_values[value_keys] = np.arange(len(value_keys))
+        word_values = key_values[self.word_keys]
+        is_ranked = word_values >= 0
+        # Within a group of equal texts, word starts are ordered by value id
+        order = np.lexsort((word_values[is_ranked], self.word_groups[is_ranked]))
+        return PrefixIndex(
+            [self.values[value_id] for value_id in value_ids.tolist()],
+            [self.keys[key_id] for key_id in value_keys.tolist()],
+            word_values[is_ranked][order].astype(np.int32),
+            self.word_starts[is_ranked][order],
+        )
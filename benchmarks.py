@@ -0,0 +1,391 @@
+"""
+
+This file contains the benchmark suite. It generates a synthetic dataset in a
+scratch directory, runs the preprocessing step on it, then times every public
+RecommendationSystem method and every Flask route against the artifacts it
+produced, plus a burst of identical requests to the ASGI application. Results
+can be saved as a baseline and later runs compared against it; a benchmark
+regresses when its median is slower than the baseline by more than the
+threshold factor.
+
+Usage:
+    python benchmarks.py --save-baseline benchmark_baseline.json
+    python benchmarks.py --baseline benchmark_baseline.json --threshold 1.5
+
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import numpy as np
+
+from pipeline import STAGE_CACHE_DIR
+from recommendations import RecommendationSystem
+from recommendations_preprocessing import (
+    MIN_BOOK_RATINGS,
+    MIN_USER_RATINGS,
+    RecommendationsPreprocessing,
+)
+from synthetic_dataset import (
+    BOOKS_COUNT,
+    RATINGS_COUNT,
+    USERS_COUNT,
+    SyntheticDataset,
+)
+
+BENCHMARK_REPEATS = 50
+PREPROCESSING_REPEATS = 3
+REGRESSION_THRESHOLD = 1.5
+# Differences below this many seconds are timer noise, not regressions
+REGRESSION_SLACK = 0.0005
+BATCH_SIZE = 100
+# Identical requests sent at once to the ASGI application
+BURST_SIZE = 50
+LOCATIONS = ["california", "usa", "berlin", "united kingdom", "nowhere"]
+
+
+class BenchmarkSuite:
+    def __init__(self, repeats=BENCHMARK_REPEATS):
+        self.repeats = repeats
+        self.results = {}
+
+    @staticmethod
+    def partial_inputs(titles, authors, publishers):
+        """What a user has typed so far, for every search type with suggestions."""
+        return {
+            "bookname": [title[:3] for title in titles],
+            "author": [author[:2] for author in authors],
+            "publisher": [publisher[:2] for publisher in publishers],
+            "location": [location[:2] for location in LOCATIONS],
+        }
+
+    def measure(self, name, function, inputs, repeats=None):
+        """Time function over inputs, cycling through them; one warm-up call."""
+        repeats = repeats or self.repeats
+        function(inputs[0])
+        durations = []
+        for repeat in range(repeats):
+            argument = inputs[repeat % len(inputs)]
+            start = time.perf_counter()
+            function(argument)
+            durations.append(time.perf_counter() - start)
+
+        self.results[name] = {
+            "median": float(np.median(durations)),
+            "p95": float(np.percentile(durations, 95)),
+            "repeats": repeats,
+        }
+        print(
+            f"{name:<62} {self.results[name]['median'] * 1000:>10.3f} ms"
+            f" {self.results[name]['p95'] * 1000:>10.3f} ms"
+        )
+
+    def run_preprocessing(self, min_user_ratings, min_book_ratings):
+        def preprocess(use_cache):
+            if not use_cache and os.path.isdir(STAGE_CACHE_DIR):
+                for filename in os.listdir(STAGE_CACHE_DIR):
+                    os.remove(os.path.join(STAGE_CACHE_DIR, filename))
+            RecommendationsPreprocessing(
+                min_user_ratings, min_book_ratings
+            ).preprocess_data()
+
+        self.measure(
+            "RecommendationsPreprocessing.preprocess_data",
+            preprocess,
+            [False],
+            PREPROCESSING_REPEATS,
+        )
+        self.measure(
+            "RecommendationsPreprocessing.preprocess_data (cached stages)",
+            preprocess,
+            [True],
+            PREPROCESSING_REPEATS,
+        )
+
+    def run_recommendations(self):
+        # Without a result cache every call measures the full lookup
+        system = RecommendationSystem(cache_size=0)
+        self.measure(
+            "RecommendationSystem.load_data", lambda _: system.load_data(), [0]
+        )
+
+        titles = list(system.book_titles[:200])
+        collaborative_titles = list(system.collaborative_titles[:200]) or titles
+        authors = list(dict.fromkeys(system.book_authors[:200]))
+        publishers = list(dict.fromkeys(system.df_catalogue["Publisher"][:200]))
+        years = [str(year) for year in range(1950, 2005)]
+        batches = [titles[start : start + BATCH_SIZE] for start in (0, 50, 100)]
+        results = system.get_recommendations_by_book(titles[0])
+
+        benchmarks = [
+            ("recommend_books_by_author", titles),
+            ("recommend_books_by_publisher", titles),
+            ("recommendation_by_given_author", authors),
+            ("recommendation_by_given_publisher", publishers),
+            ("collaborative_recommendation", collaborative_titles),
+            ("recommendations_by_year", years),
+            ("recommendations_by_location", LOCATIONS),
+            ("recommendation_by_same_place", titles),
+            ("get_recommendations_by_book", collaborative_titles),
+            ("get_recommendations_by_books", batches),
+            ("get_recommendations_by_author", authors),
+            ("get_recommendations_by_publisher", publishers),
+            ("get_recommendations_by_year", years),
+            ("get_recommendations_by_location", LOCATIONS),
+            ("results_in_json", [results]),
+        ]
+        for method, inputs in benchmarks:
+            self.measure(
+                f"RecommendationSystem.{method}", getattr(system, method), inputs
+            )
+
+        embedding_system = RecommendationSystem(
+            cache_size=0, collaborative_engine="embedding"
+        )
+        embedding_system.load_data()
+        self.measure(
+            "RecommendationSystem.collaborative_recommendation (embedding)",
+            embedding_system.collaborative_recommendation,
+            titles,
+        )
+        self.measure(
+            "RecommendationSystem.search_books (author, country, years)",
+            lambda author: system.search_books(
+                author=author, country="usa", year_from=1980, year_to=2000
+            ),
+            authors,
+        )
+        self.measure(
+            "RecommendationSystem.search_books (years, third page)",
+            lambda year: system.search_books(
+                year_from=int(year), year_to=int(year) + 10, offset=20
+            ),
+            years,
+        )
+        partial_inputs = self.partial_inputs(titles, authors, publishers)
+        for search_type, inputs in partial_inputs.items():
+            self.measure(
+                f"RecommendationSystem.suggestions searchBy={search_type}",
+                lambda prefix, search_type=search_type: system.suggestions(
+                    search_type, prefix
+                ),
+                inputs,
+            )
+        return titles, authors, publishers, years
+
+    def run_routes(self, titles, authors, publishers, years):
+        # The app serves the artifacts of the working directory
+        app = importlib.import_module("app").create_app(watch=False)
+        client = app.test_client()
+        cache = app.extensions["recommendations"]["snapshots"].current.result_cache
+
+        def request(method, path, **builders):
+            """Build a benchmark function sending one request per input."""
+
+            def send(argument):
+                cache.clear()
+                options = {key: build(argument) for key, build in builders.items()}
+                response = getattr(client, method)(path, **options)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{path} returned {response.status_code}")
+
+            return send
+
+        searches = {
+            "bookname": titles,
+            "author": authors,
+            "publisher": publishers,
+            "year": years,
+            "location": LOCATIONS,
+        }
+        self.measure("GET /", request("get", "/"), [0])
+        self.measure("GET /recommend", request("get", "/recommend"), [0])
+        for search_type, inputs in searches.items():
+            self.measure(
+                f"POST /recommend_books searchBy={search_type}",
+                request(
+                    "post",
+                    "/recommend_books",
+                    data=lambda value, search_type=search_type: {
+                        "searchBy": search_type,
+                        "user-input": value,
+                    },
+                ),
+                inputs,
+            )
+            self.measure(
+                f"GET /api/recommend searchBy={search_type}",
+                request(
+                    "get",
+                    "/api/recommend",
+                    query_string=lambda value, search_type=search_type: {
+                        "searchBy": search_type,
+                        "user-input": value,
+                    },
+                ),
+                inputs,
+            )
+        self.measure(
+            "GET /api/search author, country and years",
+            request(
+                "get",
+                "/api/search",
+                query_string=lambda author: {
+                    "author": author,
+                    "country": "usa",
+                    "year_from": 1980,
+                    "year_to": 2000,
+                },
+            ),
+            authors,
+        )
+        self.measure(
+            "POST /api/recommend/batch",
+            request(
+                "post", "/api/recommend/batch", json=lambda value: {"titles": value}
+            ),
+            [titles[start : start + BATCH_SIZE] for start in (0, 50, 100)],
+        )
+        partial_inputs = self.partial_inputs(titles, authors, publishers)
+        for search_type, inputs in partial_inputs.items():
+            self.measure(
+                f"GET /api/autocomplete searchBy={search_type}",
+                request(
+                    "get",
+                    "/api/autocomplete",
+                    query_string=lambda prefix, search_type=search_type: {
+                        "searchBy": search_type,
+                        "user-input": prefix,
+                    },
+                ),
+                inputs,
+            )
+        # Every request above has been recorded, so the registry is full
+        self.measure("GET /metrics", request("get", "/metrics"), [0])
+
+    def run_asgi_burst(self, titles):
+        server = importlib.import_module("asgi").create_asgi_app(watch=False)
+        cache = server.snapshots.current.result_cache
+
+        async def post(body):
+            """Send one form POST to /recommend_books in-process."""
+            scope = {
+                "type": "http",
+                "method": "POST",
+                "path": "/recommend_books",
+                "query_string": b"",
+                "headers": [(b"content-type", b"application/x-www-form-urlencoded")],
+            }
+            messages = [{"type": "http.request", "body": body}]
+            sent = []
+
+            async def receive():
+                return messages.pop()
+
+            async def send(message):
+                sent.append(message)
+
+            await server(scope, receive, send)
+            if sent[0]["status"] != 200:
+                raise RuntimeError(f"/recommend_books returned {sent[0]['status']}")
+
+        async def burst(title):
+            body = urlencode({"searchBy": "bookname", "user-input": title}).encode()
+            await asyncio.gather(*[post(body) for _ in range(BURST_SIZE)])
+
+        def send_burst(title):
+            cache.clear()
+            asyncio.run(burst(title))
+
+        self.measure(
+            f"ASGI burst of {BURST_SIZE} identical POST /recommend_books",
+            send_burst,
+            titles,
+        )
+        server.close()
+
+    def compare(self, baseline, threshold=REGRESSION_THRESHOLD):
+        """Return (name, baseline median, median) of every regressed benchmark."""
+        regressions = []
+        for name, result in self.results.items():
+            expected = baseline.get("results", {}).get(name)
+            if expected is None:
+                continue
+            limit = max(
+                expected["median"] * threshold, expected["median"] + REGRESSION_SLACK
+            )
+            if result["median"] > limit:
+                regressions.append((name, expected["median"], result["median"]))
+        return regressions
+
+
+def run(arguments):
+    dataset = {
+        "books": arguments.books,
+        "users": arguments.users,
+        "ratings": arguments.ratings,
+        "seed": arguments.seed,
+        "min_user_ratings": arguments.min_user_ratings,
+        "min_book_ratings": arguments.min_book_ratings,
+    }
+    repository = os.getcwd()
+    baseline_path = arguments.baseline and os.path.abspath(arguments.baseline)
+    save_path = arguments.save_baseline and os.path.abspath(arguments.save_baseline)
+
+    with tempfile.TemporaryDirectory(prefix="benchmarks-") as workdir:
+        # The preprocessing step and the app use paths relative to the cwd
+        os.chdir(workdir)
+        SyntheticDataset(
+            arguments.books, arguments.users, arguments.ratings, arguments.seed
+        ).write("Dataset")
+
+        suite = BenchmarkSuite(arguments.repeats)
+        print(f"{'benchmark':<62} {'median':>13} {'p95':>13}")
+        suite.run_preprocessing(arguments.min_user_ratings, arguments.min_book_ratings)
+        titles, authors, publishers, years = suite.run_recommendations()
+        suite.run_routes(titles, authors, publishers, years)
+        suite.run_asgi_burst(titles)
+        os.chdir(repository)
+
+    if save_path:
+        with open(save_path, "w") as file:
+            json.dump({"dataset": dataset, "results": suite.results}, file, indent=4)
+        print(f"Saved baseline to {save_path}")
+
+    if baseline_path:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        if baseline.get("dataset") != dataset:
+            print("Error: the baseline was recorded with different dataset settings")
+            return 2
+        regressions = suite.compare(baseline, arguments.threshold)
+        for name, expected, measured in regressions:
+            print(
+                f"Regression: {name} {expected * 1000:.3f} ms ->"
+                f" {measured * 1000:.3f} ms"
+            )
+        if regressions:
+            return 1
+        print(f"No regressions beyond {arguments.threshold}x the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--books", type=int, default=BOOKS_COUNT)
+    parser.add_argument("--users", type=int, default=USERS_COUNT)
+    parser.add_argument("--ratings", type=int, default=RATINGS_COUNT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-user-ratings", type=int, default=MIN_USER_RATINGS)
+    parser.add_argument("--min-book-ratings", type=int, default=MIN_BOOK_RATINGS)
+    parser.add_argument("--repeats", type=int, default=BENCHMARK_REPEATS)
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare the results with this file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    sys.exit(run(parser.parse_args()))
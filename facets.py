@@ -0,0 +1,141 @@
+"""
+
+This file contains the indexes behind the faceted book search. A FacetIndex
+holds a posting list for every value of a facet, such as an author or a
+country: the sorted ids of the books with that value. A RangeIndex holds the
+book ids ordered by a numeric value, such as the publication year, so a value
+range is a single slice.
+
+Book ids are ranked by aggregated rating, so the best matches of a query are
+its smallest book ids. Sorted posting lists are intersected starting from the
+shortest one, and a page of results is the smallest ids of the intersection,
+found with a partial sort where the ids are not already ordered.
+
+"""
+import numpy as np
+import pandas as pd
+
+from artifact_store import slice_offsets
+from search_index import TitleIndex
+
+FACET_PAGE_SIZE = 10
+EMPTY_BOOK_IDS = np.empty(0, dtype=np.int32)
+
+
+class FacetIndex:
+    def __init__(self, keys, offsets, book_ids):
+        self.keys = keys
+        self.offsets = offsets
+        self.book_ids = book_ids
+        self.key_slots = {key: slot for slot, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, values, book_ids):
+        """Index book ids by value; values are normalised like titles."""
+        # Each distinct value is normalised once, however many books have it
+        value_codes, distinct_values = pd.factorize(pd.Series(values))
+        keys = np.array(
+            [TitleIndex.normalise(str(value)) for value in distinct_values],
+            dtype=object,
+        )
+        df_postings = pd.DataFrame(
+            {
+                "key": keys[value_codes],
+                "book_id": np.asarray(book_ids, dtype=np.int32),
+            }
+        )[value_codes >= 0]
+        df_postings = (
+            df_postings[(df_postings["key"] != "") & (df_postings["book_id"] >= 0)]
+            .drop_duplicates()
+            .sort_values(["key", "book_id"], kind="stable")
+        )
+
+        counts = df_postings.groupby("key", sort=True).size()
+        return cls(
+            counts.index.tolist(),
+            slice_offsets(counts.to_numpy()),
+            df_postings["book_id"].to_numpy(dtype=np.int32),
+        )
+
+    @classmethod
+    def from_store(cls, store, name):
+        return cls(
+            store.array(f"{name}.keys").to_list(),
+            store.array(f"{name}.offsets"),
+            store.array(f"{name}.book_ids"),
+        )
+
+    def write(self, writer, name):
+        writer.write_strings(f"{name}.keys", self.keys)
+        writer.write_array(f"{name}.offsets", self.offsets)
+        writer.write_array(f"{name}.book_ids", self.book_ids)
+
+    def books(self, value):
+        """Sorted ids of the books with a value, matched after normalisation."""
+        slot = self.key_slots.get(TitleIndex.normalise(str(value)))
+        if slot is None:
+            return EMPTY_BOOK_IDS
+        return self.book_ids[self.offsets[slot] : self.offsets[slot + 1]]
+
+
+class RangeIndex:
+    def __init__(self, values, book_ids):
+        self.values = values
+        self.book_ids = book_ids
+
+    @classmethod
+    def build(cls, values):
+        """Order book ids, the positions of values, by value."""
+        values = np.asarray(values)
+        order = np.argsort(values, kind="stable")
+        return cls(values[order], order.astype(np.int32))
+
+    @classmethod
+    def from_store(cls, store, name):
+        return cls(store.array(f"{name}.values"), store.array(f"{name}.book_ids"))
+
+    def write(self, writer, name):
+        writer.write_array(f"{name}.values", self.values)
+        writer.write_array(f"{name}.book_ids", self.book_ids)
+
+    def books(self, low=None, high=None):
+        """Ids of the books valued between low and high, both included and optional.
+
+        The ids are ordered by value, not by book id.
+        """
+        start = 0 if low is None else np.searchsorted(self.values, low, side="left")
+        end = (
+            len(self.values)
+            if high is None
+            else np.searchsorted(self.values, high, side="right")
+        )
+        return self.book_ids[start:end]
+
+
+def intersect_sorted(posting_lists):
+    """Book ids present in every sorted posting list, sorted."""
+    posting_lists = sorted(posting_lists, key=len)
+    book_ids = np.asarray(posting_lists[0])
+    for posting_list in posting_lists[1:]:
+        if len(book_ids) == 0:
+            break
+        positions = np.searchsorted(posting_list, book_ids)
+        is_present = positions < len(posting_list)
+        is_present[is_present] = (
+            posting_list[positions[is_present]] == book_ids[is_present]
+        )
+        book_ids = book_ids[is_present]
+    return book_ids
+
+
+def smallest_page(book_ids, offset, limit, is_sorted=False):
+    """The smallest book ids from rank offset on, at most limit of them, sorted."""
+    end = offset + limit
+    if not is_sorted:
+        if end < len(book_ids):
+            book_ids = np.partition(book_ids, end - 1)[:end]
+        book_ids = np.sort(book_ids)
+    return book_ids[offset:end]
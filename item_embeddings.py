@@ -0,0 +1,74 @@
+"""
+
+This file contains an ItemEmbeddings class holding a compact float32 vector
+for every row of a sparse book x user rating matrix, learnt with a truncated
+SVD. Books rated alike by the same users get nearby vectors, so similar books
+are found by comparing a few dozen numbers per book instead of storing a book
+x book similarity matrix; books with too few ratings for the exact neighbour
+table still get neighbours.
+
+Vectors are L2-normalised, so a dot product is their cosine similarity.
+
+"""
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+EMBEDDING_DIMENSIONS = 32
+# Rows scored against the whole catalogue at once by a batch query
+QUERY_BLOCK_ROWS = 256
+EMPTY_NEIGHBOURS = np.empty(0, dtype=np.int32)
+
+
+class ItemEmbeddings:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @classmethod
+    def build(cls, matrix, dimensions=EMBEDDING_DIMENSIONS, seed=0):
+        """Embed the rows of a sparse matrix in at most ``dimensions`` dimensions."""
+        # The SVD needs fewer components than either side of the matrix
+        dimensions = min(dimensions, min(matrix.shape) - 1)
+        if dimensions < 1:
+            return cls(np.zeros((matrix.shape[0], 0), dtype=np.float32))
+
+        svd = TruncatedSVD(n_components=dimensions, random_state=seed)
+        vectors = svd.fit_transform(matrix.astype(np.float32))
+        return cls(normalize(vectors, norm="l2").astype(np.float32))
+
+    @classmethod
+    def from_store(cls, store, name="item_embeddings"):
+        return cls(store.array(f"{name}.vectors"))
+
+    def write(self, writer, name="item_embeddings"):
+        writer.write_array(f"{name}.vectors", self.vectors)
+
+    def neighbours(self, items, k):
+        """Return the ids of the k rows most similar to each of items, best first.
+
+        Rows with a zero vector or a non-positive similarity are left out, so
+        a list may hold fewer than k ids.
+        """
+        items = np.asarray(items, dtype=np.int64)
+        k = min(k, len(self) - 1)
+        if k <= 0 or self.vectors.shape[1] == 0:
+            return [EMPTY_NEIGHBOURS for _ in items]
+
+        results = []
+        for start in range(0, len(items), QUERY_BLOCK_ROWS):
+            block = items[start : start + QUERY_BLOCK_ROWS]
+            scores = self.vectors[block] @ self.vectors.T
+            scores[np.arange(len(block)), block] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            results.extend(
+                ids[row_scores > 0].astype(np.int32)
+                for ids, row_scores in zip(top, top_scores)
+            )
+        return results
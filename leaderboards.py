@@ -0,0 +1,95 @@
+"""
+
+This file contains a Leaderboard class holding the best rated books for every
+value of a key, such as a publication year or a location. Leaderboards are
+ranked and deduplicated during preprocessing and stored as flat arrays (keys,
+offsets, book ids and ratings), so serving a key is a dictionary lookup and a
+slice.
+
+"""
+import numpy as np
+import pandas as pd
+
+from artifact_store import slice_offsets
+
+LEADERBOARD_SIZE = 20
+
+
+class Leaderboard:
+    def __init__(self, keys, offsets, book_ids, ratings):
+        self.keys = keys
+        self.offsets = offsets
+        self.book_ids = book_ids
+        self.ratings = ratings
+        self.key_slots = {key: slot for slot, key in enumerate(keys)}
+
+    @classmethod
+    def build(cls, df_ratings, key_column, size=LEADERBOARD_SIZE):
+        """Rank books per key by their best rating, ties broken by book id.
+
+        ``df_ratings`` needs the key column plus "Book-Id" and "Book-Rating".
+        """
+        df_ratings = df_ratings[df_ratings["Book-Id"] >= 0]
+        best_ratings = (
+            df_ratings.dropna(subset=[key_column])
+            .groupby([key_column, "Book-Id"], observed=True)["Book-Rating"]
+            .max()
+            .reset_index()
+            .sort_values(
+                [key_column, "Book-Rating", "Book-Id"],
+                ascending=[True, False, True],
+                kind="stable",
+            )
+        )
+        best_ratings = best_ratings.groupby(key_column, observed=True).head(size)
+
+        counts = best_ratings.groupby(key_column, observed=True).size()
+        return cls(
+            counts.index.tolist(),
+            slice_offsets(counts.to_numpy()),
+            best_ratings["Book-Id"].to_numpy(dtype=np.int32),
+            best_ratings["Book-Rating"].to_numpy(dtype=np.float32),
+        )
+
+    @classmethod
+    def from_store(cls, store, name):
+        keys = store.array(f"{name}.keys")
+        keys = keys.to_list() if hasattr(keys, "to_list") else keys.tolist()
+        return cls(
+            keys,
+            store.array(f"{name}.offsets"),
+            store.array(f"{name}.book_ids"),
+            store.array(f"{name}.ratings"),
+        )
+
+    def write(self, writer, name):
+        if all(isinstance(key, str) for key in self.keys):
+            writer.write_strings(f"{name}.keys", self.keys)
+        else:
+            writer.write_array(f"{name}.keys", np.asarray(self.keys))
+        writer.write_array(f"{name}.offsets", self.offsets)
+        writer.write_array(f"{name}.book_ids", self.book_ids)
+        writer.write_array(f"{name}.ratings", self.ratings)
+
+    def top(self, key, limit):
+        """Return the ids and ratings of the best books for a key."""
+        slot = self.key_slots.get(key)
+        if slot is None:
+            return self.book_ids[:0], self.ratings[:0]
+        start = self.offsets[slot]
+        end = min(self.offsets[slot + 1], start + limit)
+        return self.book_ids[start:end], self.ratings[start:end]
+
+    def top_of_any(self, keys, limit):
+        """Return the best books across several keys, each book listed once."""
+        entries = [self.top(key, limit) for key in keys]
+        merged = pd.DataFrame(
+            {
+                "Book-Id": np.concatenate([book_ids for book_ids, _ in entries]),
+                "Book-Rating": np.concatenate([ratings for _, ratings in entries]),
+            }
+        )
+        merged = merged.sort_values(
+            ["Book-Rating", "Book-Id"], ascending=[False, True], kind="stable"
+        ).drop_duplicates("Book-Id")[:limit]
+        return merged["Book-Id"].to_numpy(), merged["Book-Rating"].to_numpy()
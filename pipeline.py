@@ -0,0 +1,187 @@
+"""
+
+This file contains a small stage pipeline used by the preprocessing step. Every
+stage names the stages whose outputs it takes; its cache key is a hash of the
+code that defines it and of the local modules that code imports, its extra
+arguments, the contents of the files it reads and the keys of its inputs. A
+stage whose key is unchanged is loaded from the cache instead of being
+recomputed, and stages that become ready together run in separate processes.
+Stages marked in_process run in this process, one after another, so a large
+input they share is not copied into every worker.
+
+"""
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+STAGE_CACHE_DIR = "stage_cache"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class Stage:
+    def __init__(
+        self, name, function, inputs=(), arguments=(), files=(), in_process=False
+    ):
+        """``function`` is called with the outputs of ``inputs`` followed by
+        ``arguments``; ``files`` are paths whose contents the stage reads."""
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.arguments = tuple(arguments)
+        self.files = tuple(files)
+        self.in_process = in_process
+
+
+class Pipeline:
+    def __init__(self, stages, cache_dir=STAGE_CACHE_DIR, workers=None):
+        self.stages = list(stages)
+        self.cache_dir = cache_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.file_hashes = {}
+        self.module_sources = {}
+
+    def file_hash(self, path):
+        if path not in self.file_hashes:
+            digest = hashlib.sha256()
+            try:
+                with open(path, "rb") as file:
+                    for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+                        digest.update(block)
+            except FileNotFoundError:
+                digest.update(b"missing")
+            self.file_hashes[path] = digest.hexdigest()
+        return self.file_hashes[path]
+
+    @staticmethod
+    def local_modules(module):
+        """The module and the modules of its directory it imports, transitively.
+
+        A module counts as imported when it, or a class or function taken from
+        it, is a global of an importing module.
+        """
+        directory = os.path.dirname(os.path.abspath(module.__file__))
+        found, pending = {}, [module]
+        while pending:
+            current = pending.pop()
+            if current.__name__ in found:
+                continue
+            found[current.__name__] = current
+            for value in vars(current).values():
+                if inspect.isclass(value) or inspect.isfunction(value):
+                    value = sys.modules.get(value.__module__)
+                path = (
+                    getattr(value, "__file__", None)
+                    if inspect.ismodule(value)
+                    else None
+                )
+                if path and os.path.dirname(os.path.abspath(path)) == directory:
+                    pending.append(value)
+        return [found[name] for name in sorted(found)]
+
+    def code_source(self, function):
+        module = inspect.getmodule(function)
+        if module is None or getattr(module, "__file__", None) is None:
+            return inspect.getsource(function)
+        if module.__name__ not in self.module_sources:
+            self.module_sources[module.__name__] = "".join(
+                inspect.getsource(local_module)
+                for local_module in self.local_modules(module)
+            )
+        return self.module_sources[module.__name__]
+
+    def stage_key(self, stage, keys):
+        digest = hashlib.sha256(stage.name.encode("utf-8"))
+        # The defining module and the local modules it imports are hashed, so
+        # editing a helper a stage calls, in any of them, invalidates it
+        digest.update(self.code_source(stage.function).encode("utf-8"))
+        digest.update(repr(stage.arguments).encode("utf-8"))
+        for path in stage.files:
+            digest.update(self.file_hash(path).encode("utf-8"))
+        for name in stage.inputs:
+            digest.update(keys[name].encode("utf-8"))
+        return digest.hexdigest()
+
+    def cache_path(self, stage, key):
+        return os.path.join(self.cache_dir, f"{stage.name}-{key}.pkl")
+
+    def load(self, stage, key):
+        try:
+            with open(self.cache_path(stage, key), "rb") as file:
+                return True, pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def save(self, stage, key, output):
+        """Cache a stage output, replacing older outputs of the same stage."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(stage, key)
+        with open(f"{path}.tmp", "wb") as file:
+            pickle.dump(output, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith(f"{stage.name}-") and filename.endswith(".pkl"):
+                if os.path.join(self.cache_dir, filename) != path:
+                    os.remove(os.path.join(self.cache_dir, filename))
+
+    @staticmethod
+    def call(stage, outputs):
+        arguments = [outputs[name] for name in stage.inputs] + list(stage.arguments)
+        return stage.function(*arguments)
+
+    def execute(self, stages, outputs):
+        parallel = [stage for stage in stages if not stage.in_process]
+        if len(parallel) < 2 or self.workers < 2:
+            return [self.call(stage, outputs) for stage in stages]
+
+        results = {}
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(parallel))) as pool:
+            futures = {
+                stage.name: pool.submit(
+                    stage.function,
+                    *[outputs[name] for name in stage.inputs],
+                    *stage.arguments,
+                )
+                for stage in parallel
+            }
+            # In-process stages run while the workers are busy
+            for stage in stages:
+                if stage.in_process:
+                    results[stage.name] = self.call(stage, outputs)
+            for name, future in futures.items():
+                results[name] = future.result()
+        return [results[stage.name] for stage in stages]
+
+    def run(self):
+        """Run or load every stage; returns the outputs by stage name."""
+        keys, outputs = {}, {}
+        pending = list(self.stages)
+        while pending:
+            ready = [
+                stage
+                for stage in pending
+                if all(name in outputs for name in stage.inputs)
+            ]
+            if not ready:
+                raise ValueError(
+                    "Stages with missing or cyclic inputs: "
+                    + ", ".join(stage.name for stage in pending)
+                )
+
+            stale = []
+            for stage in ready:
+                keys[stage.name] = self.stage_key(stage, keys)
+                cached, output = self.load(stage, keys[stage.name])
+                if cached:
+                    outputs[stage.name] = output
+                else:
+                    stale.append(stage)
+
+            for stage, output in zip(stale, self.execute(stale, outputs)):
+                outputs[stage.name] = output
+                self.save(stage, keys[stage.name], output)
+            pending = [stage for stage in pending if stage not in ready]
+        return outputs
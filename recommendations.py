@@ -1,50 +1,391 @@
 """
 
-This file contains a RecommendationSystem class that loads data from pickle files
-and provides methods for recommending books based on various criteria.
+This file contains a RecommendationSystem class that loads the memory-mapped
+artifacts written by preprocessing and provides methods for recommending books
+based on various criteria.
 
 """
-import pickle
 import json
+import time
+from functools import cached_property, partial
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import pandas as pd
 import numpy as np
 
+from ann_index import ANN_MAX_CANDIDATES, RandomProjectionIndex
+from artifact_store import ARTIFACTS_DIR, ArtifactStore, StringColumn
+from autocomplete import SUGGESTIONS_COUNT, PrefixIndex
+from facets import (
+    FACET_PAGE_SIZE,
+    FacetIndex,
+    RangeIndex,
+    intersect_sorted,
+    smallest_page,
+)
+from item_embeddings import ItemEmbeddings
+from leaderboards import Leaderboard
+from metrics import MetricsRegistry, memory_bytes
+from result_cache import CACHE_SIZE, CACHE_TTL, MISSING, ResultCache
+from search_index import TitleIndex
+
+# Seconds a strategy may take in parallel mode before it is left out of the response
+STRATEGY_TIMEOUT = 0.5
+# "cosine" serves the exact neighbour table and falls back to the approximate
+# index; "embedding" serves the truncated-SVD item embeddings for every title
+COLLABORATIVE_ENGINES = ("cosine", "embedding")
+# Prefix index artifact completing the input of each search type
+SUGGESTION_INDEXES = {
+    "bookname": "title_suggestions",
+    "author": "author_suggestions",
+    "publisher": "publisher_suggestions",
+    "location": "location_suggestions",
+}
+# Exact-value filters of the faceted search, each backed by posting lists
+FACETS = ("author", "publisher", "country")
+
 
 class RecommendationSystem:
-    def __init__(self):
-        self.df_recommendation_dataset = pd.DataFrame()
-        self.df_author_recommendations = pd.DataFrame()
-        self.df_books = pd.DataFrame()
-        self.df_pivot_table = pd.DataFrame()
-        self.df_similarity_scores = []
-
-    def load_data(self):
-        try:
-            with open("pklFiles/books_with_ratings.pkl", "rb") as file:
-                self.df_recommendation_dataset = pickle.load(file)
+    def __init__(
+        self,
+        artifacts_dir=ARTIFACTS_DIR,
+        parallel=False,
+        strategy_timeout=STRATEGY_TIMEOUT,
+        strategy_timeouts=None,
+        cache_size=CACHE_SIZE,
+        cache_ttl=CACHE_TTL,
+        ann_tables=None,
+        ann_max_candidates=ANN_MAX_CANDIDATES,
+        collaborative_engine="cosine",
+        metrics=None,
+    ):
+        """``ann_tables`` and ``ann_max_candidates`` trade the recall of the
+        approximate similar-book search for latency; None uses every table.
+        ``collaborative_engine`` is one of COLLABORATIVE_ENGINES. Systems
+        sharing a ``metrics`` registry report into the same metrics."""
+        if collaborative_engine not in COLLABORATIVE_ENGINES:
+            raise ValueError(f"Unknown collaborative engine: {collaborative_engine}")
+        self.artifacts_dir = artifacts_dir
+        self.collaborative_engine = collaborative_engine
+        self.ann_tables = ann_tables
+        self.ann_max_candidates = ann_max_candidates
+        self.strategy_timeout = strategy_timeout
+        self.strategy_timeouts = strategy_timeouts or {}
+        self.executor = (
+            ThreadPoolExecutor(thread_name_prefix="recommendation-strategy")
+            if parallel
+            else None
+        )
+        self.metrics = metrics or MetricsRegistry()
+        self.result_cache = ResultCache(cache_size, cache_ttl, metrics=self.metrics)
+        self.request_seconds = self.metrics.histogram(
+            "recommendation_request_seconds",
+            "Time to answer a recommendation request, cache hits included.",
+            ["search_type"],
+        )
+        self.strategy_seconds = self.metrics.histogram(
+            "recommendation_strategy_seconds",
+            "Time spent in each book-name recommendation strategy.",
+            ["strategy"],
+        )
+        self.load_seconds = self.metrics.histogram(
+            "recommendation_artifact_load_seconds",
+            "Time to load each artifact; manifest is opening the version.",
+            ["artifact"],
+        )
+        self.serialisation_seconds = self.metrics.histogram(
+            "recommendation_serialisation_seconds",
+            "Time to serialise recommendations to JSON.",
+        )
+        self.empty_results = self.metrics.counter(
+            "recommendation_empty_results_total",
+            "Requests answered without any recommended book.",
+            ["search_type"],
+        )
+        self.errors = self.metrics.counter(
+            "recommendation_errors_total",
+            "Errors caught while computing recommendations.",
+            ["source"],
+        )
+        self.missed_deadlines = self.metrics.counter(
+            "recommendation_strategy_timeouts_total",
+            "Strategies left out of a response for missing their deadline.",
+            ["strategy"],
+        )
+        self.artifact_bytes = self.metrics.gauge(
+            "recommendation_artifact_bytes",
+            "Bytes held by each loaded artifact, memory-mapped pages included.",
+            ["artifact"],
+        )
+        self.artifact_version = None
+        self.store = None
 
-            with open("pklFiles/author_recommendations.pkl", "rb") as file:
-                self.df_author_recommendations = pickle.load(file)
+    @classmethod
+    def lazy_attributes(cls):
+        return [
+            name
+            for name, value in vars(cls).items()
+            if isinstance(value, cached_property)
+        ]
 
-            with open("pklFiles/books.pkl", "rb") as file:
-                self.df_books = pickle.load(file)
+    def load_data(self, version=None, preload=False):
+        """Open an artifact version, by default the one CURRENT points at.
 
-            with open("pklFiles/pivot_table.pkl", "rb") as file:
-                self.df_pivot_table = pickle.load(file)
+        Artifacts are loaded on first use unless ``preload`` is set.
+        """
+        with self.load_seconds.time("manifest"):
+            self.load_artifacts(version)
+        if preload:
+            self.preload()
 
-            with open("pklFiles/similarity_scores.pkl", "rb") as file:
-                self.df_similarity_scores = pickle.load(file)
+    def load_artifacts(self, version=None):
+        try:
+            store = ArtifactStore(self.artifacts_dir, version)
         except FileNotFoundError as e:
-            print(f"Error loading data: {e}")
+            self.record_error("load_data", f"Error loading data: {e}")
+            return
+        for name in self.lazy_attributes():
+            self.__dict__.pop(name, None)
+        self.store = store
+        self.artifact_version = store.version
+
+    def preload(self):
+        """Load every artifact and lookup structure now instead of on first use."""
+        for name in self.lazy_attributes():
+            getattr(self, name)
+
+    def artifact(self, name, load, default):
+        """Load an artifact of the open version, recording its time and size."""
+        if self.store is None:
+            return default
+        with self.load_seconds.time(name):
+            value = load(self.store)
+        self.artifact_bytes.set(name, value=memory_bytes(value))
+        return value
+
+    @cached_property
+    def df_catalogue(self):
+        return self.artifact(
+            "catalogue", lambda store: store.table("catalogue"), pd.DataFrame()
+        )
+
+    @cached_property
+    def df_top_books(self):
+        return self.artifact(
+            "top_books", lambda store: store.table("top_books"), pd.DataFrame()
+        )
+
+    @cached_property
+    def collaborative_titles(self):
+        return self.artifact(
+            "collaborative_titles",
+            lambda store: pd.Index(store.array("collaborative_titles").to_list()),
+            pd.Index([]),
+        )
+
+    @cached_property
+    def neighbour_ids(self):
+        return self.artifact(
+            "neighbour_ids",
+            lambda store: store.array("neighbour_ids"),
+            np.empty((0, 0), dtype=np.int32),
+        )
+
+    @cached_property
+    def collaborative_book_ids(self):
+        return self.artifact(
+            "collaborative_book_ids",
+            lambda store: store.array("collaborative_book_ids"),
+            np.empty(0, dtype=np.int32),
+        )
+
+    @cached_property
+    def catalogue_book_ids(self):
+        return self.artifact(
+            "catalogue_book_ids",
+            lambda store: store.array("catalogue_book_ids"),
+            np.empty(0, dtype=np.int32),
+        )
+
+    @cached_property
+    def ann_index(self):
+        return self.artifact("ann_index", RandomProjectionIndex.from_store, None)
+
+    @cached_property
+    def item_embeddings(self):
+        return self.artifact("item_embeddings", ItemEmbeddings.from_store, None)
+
+    @cached_property
+    def prefix_indexes(self):
+        return self.artifact(
+            "prefix_indexes",
+            lambda store: {
+                search_type: PrefixIndex.from_store(store, name)
+                for search_type, name in SUGGESTION_INDEXES.items()
+            },
+            {},
+        )
+
+    @cached_property
+    def facet_indexes(self):
+        return self.artifact(
+            "facet_indexes",
+            lambda store: {
+                facet: FacetIndex.from_store(store, f"{facet}_facet")
+                for facet in FACETS
+            },
+            {},
+        )
+
+    @cached_property
+    def year_index(self):
+        return self.artifact(
+            "year_index",
+            lambda store: RangeIndex.from_store(store, "year_index"),
+            RangeIndex(np.empty(0, dtype=np.int16), np.empty(0, dtype=np.int32)),
+        )
+
+    @cached_property
+    def title_index(self):
+        return self.artifact("title_index", TitleIndex.from_store, TitleIndex([]))
+
+    @cached_property
+    def year_leaderboard(self):
+        return self.artifact(
+            "year_leaderboard",
+            lambda store: Leaderboard.from_store(store, "year_leaderboard"),
+            Leaderboard([], np.zeros(1, dtype=np.int64), [], []),
+        )
+
+    @cached_property
+    def place_leaderboard(self):
+        return self.artifact(
+            "place_leaderboard",
+            lambda store: Leaderboard.from_store(store, "place_leaderboard"),
+            Leaderboard([], np.zeros(1, dtype=np.int64), [], []),
+        )
+
+    # Columns served for every recommended book, addressed by book id. Book ids
+    # are row positions in the catalogue table, which holds one row per title
+    # ordered by aggregated rating. The strings stay in the memory-mapped
+    # artifact and are decoded per request, so workers forked after a preload
+    # keep sharing their pages.
+    def served_column(self, name, table, column):
+        return self.artifact(
+            name, lambda store: store.string_column(table, column), StringColumn.empty()
+        )
+
+    @cached_property
+    def book_titles(self):
+        return self.served_column("book_titles", "catalogue", "Book-Title")
+
+    @cached_property
+    def book_authors(self):
+        return self.served_column("book_authors", "catalogue", "Book-Author")
+
+    @cached_property
+    def book_covers(self):
+        return self.served_column("book_covers", "catalogue", "Image-URL-M")
+
+    @cached_property
+    def book_years(self):
+        if "Year-Of-Publication" not in self.df_catalogue:
+            return np.empty(0, dtype=np.int16)
+        return self.df_catalogue["Year-Of-Publication"].to_numpy()
+
+    @cached_property
+    def book_places(self):
+        """City, state and country columns of where every book was first rated."""
+        return [
+            self.served_column(f"book_places.{column}", "book_places", column)
+            for column in ("City", "State", "Country")
+        ]
+
+    @cached_property
+    def catalogue_categories(self):
+        """Codes and lowercased categories of the author and publisher columns.
+
+        Searches match the few distinct values, then select books by code.
+        """
+        categories = {}
+        for column in ("Book-Author", "Publisher"):
+            if column in self.df_catalogue:
+                values = self.df_catalogue[column].cat
+                categories[column] = (
+                    values.codes.to_numpy(),
+                    values.categories.str.lower(),
+                )
+        return categories
+
+    def rows_by_book(self, book_ids):
+        """Invert an array of book ids into the row of every book, or -1."""
+        rows = np.full(len(self.book_titles), -1, dtype=np.int32)
+        indexed = book_ids >= 0
+        rows[book_ids[indexed]] = np.flatnonzero(indexed)
+        return rows
+
+    @cached_property
+    def collaborative_rows_by_book(self):
+        """Row of every book in the exact neighbour table, or -1."""
+        return self.rows_by_book(self.collaborative_book_ids)
+
+    @cached_property
+    def catalogue_items_by_book(self):
+        """Row of every book in the catalogue-wide indexes, or -1."""
+        return self.rows_by_book(self.catalogue_book_ids)
 
+    def warm_up(self):
+        """Answer a few representative requests, bypassing the result cache.
+
+        The first requests on freshly loaded artifacts otherwise pay for page
+        faults and for the lookup tables pandas builds lazily.
+        """
+        if len(self.book_titles) == 0:
+            return
+        for title in self.book_titles[:3]:
+            self.find_recommendations_by_book(title)
+            self.title_index.resolve(title[:-1])
+            for prefix_index in self.prefix_indexes.values():
+                prefix_index.suggest(title[:2])
+        self.find_recommendations_by_author(self.book_authors[0])
+        self.find_recommendations_by_publisher(self.df_catalogue["Publisher"].iat[0])
+        self.find_recommendations_by_year(self.book_titles[0])
+        if self.place_leaderboard.keys:
+            self.find_recommendations_by_location(self.place_leaderboard.keys[0])
+
+    def restart_executor(self):
+        """Give a forked process strategy threads of its own.
+
+        Threads do not survive a fork, so an executor inherited from the parent
+        would queue work that no thread ever picks up.
+        """
+        if self.executor is not None:
+            self.executor = ThreadPoolExecutor(
+                thread_name_prefix="recommendation-strategy"
+            )
+
+    def close(self):
+        """Release the strategy threads; requests already running may finish."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def record_error(self, source, message):
+        self.errors.inc(source)
+        print(message)
+
+    # Results are built for every request, so they carry no per-instance dict
     # pylint: disable=too-few-public-methods
     class Recommendations:
+        __slots__ = ("title", "books")
+
         def __init__(self, title, books):
             self.title = title
             self.books = books
 
     # pylint: disable=too-few-public-methods
     class Book:
+        __slots__ = ("name", "cover", "author")
+
         def __init__(self, name, cover, author):
             self.name = name
             self.cover = cover
@@ -54,52 +395,77 @@ class RecommendationSystem:
         recommendation_books = self.Recommendations(title, books)
         return recommendation_books
 
+    def create_book(self, book_id):
+        return self.Book(
+            self.book_titles[book_id],
+            self.book_covers[book_id],
+            self.book_authors[book_id],
+        )
+
+    def resolve_title(self, book_name):
+        """Map free-text input to the book id every strategy recommends for."""
+        return self.title_index.resolve(book_name)
+
     def recommend_books(self, book_name, recommendation_type):
         """Recommend books based on the same author or publisher."""
-        books_list = []
-
         try:
-            book_name = book_name.lower()
-            book_entry = self.df_author_recommendations[
-                self.df_author_recommendations["Book-Title"]
-                .str.lower()
-                .str.contains(book_name)
-            ]
+            return self.recommend_books_for_ids(
+                [self.resolve_title(book_name)], recommendation_type
+            )[0]
+        except KeyError as e:
+            self.record_error("recommend_books", f"Error in recommend_books: {e}")
 
-            if book_entry.empty:
-                return self.create_book_lists_helper(
-                    f"Oops! No {recommendation_type} recommendations for the input",
-                    books_list,
-                )
+    def recommend_books_for_ids(self, book_ids, recommendation_type):
+        """Recommend books sharing the author or publisher of every book id.
 
-            if recommendation_type == "author":
-                recommendation_column = "Book-Author"
-            elif recommendation_type == "publisher":
-                recommendation_column = "Publisher"
-            else:
-                return self.create_book_lists_helper(
-                    "Invalid recommendation type", books_list
-                )
-
-            book_value = book_entry[recommendation_column].iloc[0]
-            recommendation_df = self.df_author_recommendations[
-                self.df_author_recommendations[recommendation_column] == book_value
-            ][:5]
+        All distinct authors or publishers are looked up in one pass over the
+        catalogue. A book id of None stands for an input that matched no title.
+        """
+        if recommendation_type == "author":
+            recommendation_column = "Book-Author"
+        elif recommendation_type == "publisher":
+            recommendation_column = "Publisher"
+        else:
+            return [
+                self.create_book_lists_helper("Invalid recommendation type", [])
+                for _ in book_ids
+            ]
 
-            recommendation_df.drop(
-                recommendation_df.index[recommendation_df["Book-Title"] == book_name],
-                inplace=True,
-            )
+        codes, _ = self.catalogue_categories[recommendation_column]
+        book_values = {
+            book_id: codes[book_id] for book_id in book_ids if book_id is not None
+        }
+        # Books sharing a value, grouped by value and kept in catalogue order
+        top_books = np.flatnonzero(np.isin(codes, list(set(book_values.values()))))
+        top_books = top_books[np.argsort(codes[top_books], kind="stable")]
+        values, starts = np.unique(codes[top_books], return_index=True)
+        ends = np.append(starts[1:], len(top_books))
+        top_ids_by_value = {
+            value: top_books[start : min(start + 5, end)]
+            for value, start, end in zip(values, starts, ends)
+        }
 
-            for book_info in recommendation_df.values.tolist():
-                recommended_book = self.Book(book_info[0], book_info[8], book_info[5])
-                books_list.append(recommended_book)
+        results = []
+        for book_id in book_ids:
+            books_list = []
+            if book_id is None:
+                results.append(
+                    self.create_book_lists_helper(
+                        f"Oops! No {recommendation_type} recommendations for the input",
+                        books_list,
+                    )
+                )
+                continue
 
-            return self.create_book_lists_helper(
-                f"Top Books with same {recommendation_type}", books_list
+            for recommended_id in top_ids_by_value[book_values[book_id]]:
+                if recommended_id != book_id:
+                    books_list.append(self.create_book(recommended_id))
+            results.append(
+                self.create_book_lists_helper(
+                    f"Top Books with same {recommendation_type}", books_list
+                )
             )
-        except KeyError as e:
-            print(f"Error in recommend_books: {e}")
+        return results
 
     def recommend_books_by_author(self, book_name):
         return self.recommend_books(book_name, "author")
@@ -111,30 +477,31 @@ class RecommendationSystem:
         books_list = []
 
         try:
-            category_name = category_name.lower()
-            category_recommendations = self.df_author_recommendations.loc[
-                pd.notna(self.df_author_recommendations[category_column])
-                & self.df_author_recommendations[category_column]
-                .str.lower()
-                .str.contains(category_name),
-                :,
-            ][:5]
-
-            if category_recommendations.empty:
+            codes, categories = self.catalogue_categories[category_column]
+            matched_values = np.flatnonzero(
+                categories.str.contains(category_name.lower(), regex=False)
+            )
+            category_recommendations = np.flatnonzero(np.isin(codes, matched_values))[
+                :5
+            ]
+
+            if len(category_recommendations) == 0:
                 return self.create_book_lists_helper(
                     f"Oops! No {category_column} recommendations for the input",
                     books_list,
                 )
 
-            for book_info in category_recommendations.values.tolist():
-                recommended_book = self.Book(book_info[0], book_info[8], book_info[5])
-                books_list.append(recommended_book)
+            for recommended_id in category_recommendations:
+                books_list.append(self.create_book(recommended_id))
 
             return self.create_book_lists_helper(
                 f"Similar top Books by given {category_column}", books_list
             )
         except KeyError as e:
-            print(f"Error in recommendation_by_given_category: {e}")
+            self.record_error(
+                "recommendation_by_given_category",
+                f"Error in recommendation_by_given_category: {e}",
+            )
 
     def recommendation_by_given_author(self, author_name):
         return self.recommendation_by_given_category(author_name, "Book-Author")
@@ -144,96 +511,156 @@ class RecommendationSystem:
 
     def collaborative_recommendation(self, book_name):
         """Recommendation based on trending similar books."""
-        books_list = []
-
         try:
-            array_size = np.where(self.df_pivot_table.index == book_name)[0]
-            if array_size.size == 0:
-                return self.create_book_lists_helper(
-                    "oops! No trending recommendations for the input", books_list
-                )
-            book_index = np.where(self.df_pivot_table.index == book_name)[0][0]
-            similar_books = sorted(
-                list(enumerate(self.df_similarity_scores[book_index])),
-                key=lambda x: x[1],
-                reverse=True,
-            )[1:6]
-            if len(similar_books) == 0:
-                return self.create_book_lists_helper(
-                    "Top trending similar books", books_list
-                )
+            return self.collaborative_recommendations([book_name])[0]
+        except KeyError as e:
+            self.record_error(
+                "collaborative_recommendation",
+                f"Value error in collaborative_recommendation: {e}",
+            )
 
-            for book_info in similar_books:
-                temp_df = self.df_books[
-                    self.df_books["Book-Title"]
-                    == self.df_pivot_table.index[book_info[0]]
-                ]
-                book_title = temp_df.drop_duplicates("Book-Title")["Book-Title"].values
-                book_author = temp_df.drop_duplicates("Book-Title")[
-                    "Book-Author"
-                ].values
-                cover_image = temp_df.drop_duplicates("Book-Title")[
-                    "Image-URL-M"
-                ].values
-                recommended_book = self.Book(
-                    book_title[0], cover_image[0], book_author[0]
+    def collaborative_recommendations(self, book_names):
+        return self.collaborative_recommendations_for_ids(
+            [self.resolve_title(book_name) for book_name in book_names]
+        )
+
+    def collaborative_recommendations_for_ids(self, book_ids):
+        """Trending similar books for every book id, from the configured engine.
+
+        A book id of None stands for an input that matched no title.
+        """
+        book_ids = np.array(
+            [-1 if book_id is None else book_id for book_id in book_ids],
+            dtype=np.int64,
+        )
+        if self.collaborative_engine == "embedding":
+            similar_books = self.embedding_neighbours(book_ids)
+        else:
+            similar_books = self.cosine_neighbours(book_ids)
+
+        results = []
+        for recommended_ids in similar_books:
+            books_list = []
+            if recommended_ids is None:
+                results.append(
+                    self.create_book_lists_helper(
+                        "oops! No trending recommendations for the input", books_list
+                    )
                 )
-                books_list.append(recommended_book)
+                continue
 
-            return self.create_book_lists_helper(
-                "Top trending similar books", books_list
+            for recommended_id in recommended_ids:
+                if recommended_id >= 0:
+                    books_list.append(self.create_book(recommended_id))
+            results.append(
+                self.create_book_lists_helper("Top trending similar books", books_list)
             )
+        return results
 
-        except KeyError as e:
-            print(f"Value error in collaborative_recommendation: {e}")
+    def cosine_neighbours(self, book_ids, k=5):
+        """Book ids of the k books most similar to every book id (-1 for none).
+
+        Books in the exact neighbour table are looked up as one array
+        operation; any other rated book is searched in the approximate
+        neighbour index.
+        """
+        book_indexes = np.where(
+            book_ids >= 0, self.collaborative_rows_by_book[np.maximum(book_ids, 0)], -1
+        )
+        matched = book_indexes >= 0
+        similar_books = iter(
+            self.collaborative_book_ids[self.neighbour_ids[book_indexes[matched], :k]]
+        )
+        return [
+            next(similar_books) if is_matched else self.ann_neighbours(book_id, k)
+            for is_matched, book_id in zip(matched, book_ids)
+        ]
+
+    def catalogue_item(self, book_id):
+        """Row of a book in the catalogue-wide indexes, or -1."""
+        if book_id < 0:
+            return -1
+        return self.catalogue_items_by_book[book_id]
+
+    def ann_neighbours(self, book_id, k=5):
+        """Book ids of about the k books rated most like book_id, or None."""
+        item = self.catalogue_item(book_id)
+        if self.ann_index is None or item < 0:
+            return None
+        items, _ = self.ann_index.neighbours(
+            item, k, self.ann_tables, self.ann_max_candidates
+        )
+        return self.catalogue_book_ids[items]
+
+    def embedding_neighbours(self, book_ids, k=5):
+        """Book ids of the k books nearest to every book id in the embedding space."""
+        items = np.array(
+            [self.catalogue_item(book_id) for book_id in book_ids], dtype=np.int64
+        )
+        similar_books = [None] * len(items)
+        if self.item_embeddings is None:
+            return similar_books
+
+        embedded = np.flatnonzero(items >= 0)
+        for position, neighbour_items in zip(
+            embedded, self.item_embeddings.neighbours(items[embedded], k)
+        ):
+            similar_books[position] = self.catalogue_book_ids[neighbour_items]
+        return similar_books
 
     def recommendations_by_year(self, year_or_book: int or str):
-        books_list = []
-        try:
-            year_of_publication = int(year_or_book)
-            if year_of_publication < 1900:
-                return self.create_book_lists_helper(
-                    "oops! Please input the valid year between 1900 - 2022", books_list
-                )
-            if year_of_publication > 2022:
-                return self.create_book_lists_helper(
-                    "oops! Please input the valid year between 1900 - 2022", books_list
-                )
-            same_year_books = self.df_recommendation_dataset[
-                self.df_recommendation_dataset["Year-Of-Publication"]
-                == year_of_publication
-            ]
-        except ValueError:
-            same_year_books = self.df_recommendation_dataset[
-                self.df_recommendation_dataset["Book-Title"]
-                .str.lower()
-                .str.contains(year_or_book.lower())
-            ]
-            if len(same_year_books) == 0:
-                return self.create_book_lists_helper(
-                    "oops! No yearly recommendations for the input", books_list
+        return self.recommendations_by_years([year_or_book])[0]
+
+    def recommendations_by_years(self, years_or_books, book_ids=None):
+        """Trending books of the given year, or of the given book's year, per input.
+
+        Every distinct year is looked up once. ``book_ids`` may carry the title
+        match of every input when it has already been resolved.
+        """
+        results = []
+        results_by_year = {}
+        for position, year_or_book in enumerate(years_or_books):
+            try:
+                year_of_publication = int(year_or_book)
+                if year_of_publication < 1900 or year_of_publication > 2022:
+                    results.append(
+                        self.create_book_lists_helper(
+                            "oops! Please input the valid year between 1900 - 2022",
+                            [],
+                        )
+                    )
+                    continue
+            except ValueError:
+                if book_ids is None:
+                    book_id = self.resolve_title(year_or_book)
+                else:
+                    book_id = book_ids[position]
+                if book_id is None:
+                    results.append(
+                        self.create_book_lists_helper(
+                            "oops! No yearly recommendations for the input", []
+                        )
+                    )
+                    continue
+                year_of_publication = int(self.book_years[book_id])
+
+            if year_of_publication not in results_by_year:
+                results_by_year[year_of_publication] = self.recommendations_for_year(
+                    year_of_publication
                 )
-            year_of_publication = same_year_books.iloc[0]["Year-Of-Publication"]
-            same_year_books = self.df_recommendation_dataset[
-                self.df_recommendation_dataset["Year-Of-Publication"]
-                == year_of_publication
-            ]
+            results.append(results_by_year[year_of_publication])
+        return results
 
+    def recommendations_for_year(self, year_of_publication):
+        books_list = []
+        same_year_books, _ = self.year_leaderboard.top(year_of_publication, 5)
         if len(same_year_books) == 0:
             return self.create_book_lists_helper(
                 "oops! No recommendations for year input", books_list
             )
 
-        same_year_books = same_year_books.sort_values(
-            by="Book-Rating", ascending=False
-        )[
-            :5
-        ]  # top 5 rated books
-
-        same_year_books = same_year_books.drop_duplicates(subset=["Book-Title"])
-        for book_info in same_year_books.values.tolist():
-            recommended_book = self.Book(book_info[0], book_info[4], book_info[1])
-            books_list.append(recommended_book)
+        for recommended_id in same_year_books:
+            books_list.append(self.create_book(recommended_id))
         return self.create_book_lists_helper(
             "Trending books in the same year", books_list
         )
@@ -245,153 +672,396 @@ class RecommendationSystem:
             if place is not None:
                 place = place.lower()
 
-            places = (
-                (self.df_recommendation_dataset["City"].str.lower() == place)
-                | (self.df_recommendation_dataset["State"].str.lower() == place)
-                | (self.df_recommendation_dataset["Country"].str.lower() == place)
-            )
-
-            if places.any():
-                same_place_books = self.df_recommendation_dataset[places]
-                same_place_books = same_place_books.sort_values(
-                    by="Book-Rating", ascending=False
-                )[
-                    :5
-                ]  # top 5 rated books
-                same_place_books = same_place_books.drop_duplicates(
-                    subset=["Book-Title"]
-                )
-                if len(same_place_books) == 0:
-                    return self.create_book_lists_helper(
-                        "oops! No recommendations for place input", books_list
-                    )
-                for book_info in same_place_books.values.tolist():
-                    recommended_book = self.Book(
-                        book_info[0], book_info[4], book_info[1]
-                    )
-                    books_list.append(recommended_book)
-                return self.create_book_lists_helper(
-                    "Trending books at the same location", books_list
-                )
-            else:
+            same_place_books, _ = self.place_leaderboard.top(place, 5)
+            if len(same_place_books) == 0:
                 return self.create_book_lists_helper(
                     "oops! No recommendations for place input", books_list
                 )
+
+            for recommended_id in same_place_books:
+                books_list.append(self.create_book(recommended_id))
+            return self.create_book_lists_helper(
+                "Trending books at the same location", books_list
+            )
         except KeyError as e:
-            print(f"Error in recommendations_by_location: {e}")
+            self.record_error(
+                "recommendations_by_location",
+                f"Error in recommendations_by_location: {e}",
+            )
 
     def recommendation_by_same_place(self, book_name):
-        books_list = []
-
         try:
-            if book_name is not None:
-                book_name = book_name.lower()
+            return self.recommendations_by_same_places([self.resolve_title(book_name)])[
+                0
+            ]
+        except KeyError as e:
+            self.record_error(
+                "recommendation_by_same_place",
+                f"Error in recommendation_by_same_place: {e}",
+            )
 
-                same_place_books = self.df_recommendation_dataset[
-                    self.df_recommendation_dataset["Book-Title"]
-                    .str.lower()
-                    .str.contains(book_name.lower())
-                ]
-                if len(same_place_books) == 0:
-                    return self.create_book_lists_helper(
-                        "oops! No recommendations for place input", books_list
-                    )
+    def recommendations_by_same_places(self, book_ids):
+        """Trending books where each book was first rated, one lookup per location."""
+        known_ids = [book_id for book_id in book_ids if book_id is not None]
+        # Places are stored lowercased; an unrated book has none
+        places_by_book = {
+            book_id: tuple(place for place in places if place is not None) or None
+            for book_id, places in zip(
+                known_ids, zip(*(column[known_ids] for column in self.book_places))
+            )
+        }
 
-            places = (
-                (
-                    self.df_recommendation_dataset["City"].str.lower()
-                    == same_place_books.iloc[0]["City"].lower()
-                )
-                | (
-                    self.df_recommendation_dataset["State"].str.lower()
-                    == same_place_books.iloc[0]["State"].lower()
-                )
-                | (
-                    self.df_recommendation_dataset["Country"].str.lower()
-                    == same_place_books.iloc[0]["Country"].lower()
-                )
+        results = []
+        results_by_places = {}
+        for book_id in book_ids:
+            places = places_by_book.get(book_id)
+            if places not in results_by_places:
+                results_by_places[places] = self.recommendations_for_places(places)
+            results.append(results_by_places[places])
+        return results
+
+    def recommendations_for_places(self, places):
+        books_list = []
+        if places is None:
+            return self.create_book_lists_helper(
+                "oops! No recommendations for place input", books_list
             )
 
-            if places.any():
-                same_place_books = self.df_recommendation_dataset[places]
-                same_place_books = same_place_books.sort_values(
-                    by="Book-Rating", ascending=False
-                )[
-                    :5
-                ]  # top 5 rated books
-                same_place_books = same_place_books.drop_duplicates(
-                    subset=["Book-Title"]
-                )
-                if len(same_place_books) == 0:
-                    return self.create_book_lists_helper(
-                        "oops! No recommendations for place input", books_list
-                    )
-                for book_info in same_place_books.values.tolist():
-                    recommended_book = self.Book(
-                        book_info[0], book_info[4], book_info[1]
-                    )
-                    books_list.append(recommended_book)
-                return self.create_book_lists_helper(
-                    "Trending books at the same location", books_list
-                )
-            else:
-                return self.create_book_lists_helper(
-                    "oops! No recommendations for place input", books_list
-                )
-        except KeyError as e:
-            print(f"Error in recommendation_by_same_place: {e}")
+        same_place_books, _ = self.place_leaderboard.top_of_any(places, 5)
+        if len(same_place_books) == 0:
+            return self.create_book_lists_helper(
+                "oops! No recommendations for place input", books_list
+            )
+
+        for recommended_id in same_place_books:
+            books_list.append(self.create_book(recommended_id))
+        return self.create_book_lists_helper(
+            "Trending books at the same location", books_list
+        )
 
     def results_in_json(self, final_recommendations):
+        """Serialise recommendations compactly for the JSON API."""
         try:
-            result = json.dumps(
-                final_recommendations, default=lambda o: o.__dict__, indent=4
-            )
+            with self.serialisation_seconds.time():
+                result = json.dumps(
+                    final_recommendations,
+                    default=lambda o: {name: getattr(o, name) for name in o.__slots__},
+                    separators=(",", ":"),
+                    ensure_ascii=False,
+                )
             return result
-        except json.JSONDecodeError as e:
-            print(f"Error in results_in_json: {e}")
+        except TypeError as e:
+            self.record_error("results_in_json", f"Error in results_in_json: {e}")
+
+    def timed_strategy(self, strategy, argument):
+        started = time.perf_counter()
+        result = strategy(argument)
+        return result, time.perf_counter() - started
+
+    def run_strategies(self, strategies, argument, timings=None):
+        """Run (name, strategy) pairs on the same argument and return their results.
 
-    def get_recommendations_by_book(self, book_name):
+        Without an executor the strategies run one after another. In parallel
+        mode they run on the thread pool and a strategy that misses its deadline
+        contributes None. Elapsed seconds per strategy are stored in ``timings``,
+        with None for a strategy that timed out.
+        """
+        if timings is None:
+            timings = {}
+
+        if self.executor is None:
+            results = []
+            for name, strategy in strategies:
+                result, timings[name] = self.timed_strategy(strategy, argument)
+                self.strategy_seconds.observe(name, value=timings[name])
+                results.append(result)
+            return results
+
+        started = time.perf_counter()
+        futures = [
+            (name, self.executor.submit(self.timed_strategy, strategy, argument))
+            for name, strategy in strategies
+        ]
+        results = []
+        for name, future in futures:
+            deadline = started + self.strategy_timeouts.get(name, self.strategy_timeout)
+            try:
+                result, timings[name] = future.result(
+                    timeout=max(deadline - time.perf_counter(), 0)
+                )
+                self.strategy_seconds.observe(name, value=timings[name])
+            except FutureTimeoutError:
+                future.cancel()
+                self.missed_deadlines.inc(name)
+                result, timings[name] = None, None
+            results.append(result)
+        return results
+
+    @staticmethod
+    def normalise_input(search_type, user_input):
+        """Reduce the input to what the strategies of a search type look at."""
+        user_input = str(user_input)
+        if search_type == "bookname":
+            # Titles are resolved after the same normalisation
+            return TitleIndex.normalise(user_input)
+        return user_input.lower()
+
+    def cache_key(self, search_type, user_input):
+        # The artifact version keeps results of an older artifact set from being served
+        return (
+            self.artifact_version,
+            search_type,
+            self.normalise_input(search_type, user_input),
+        )
+
+    def cached_results(self, search_type, user_input, compute, timings=None):
+        """Return compute(user_input) through the result cache.
+
+        Results missing a strategy that timed out are not cached.
+        """
+        with self.request_seconds.time(search_type):
+            key = self.cache_key(search_type, user_input)
+            result = self.result_cache.get(key)
+            if result is MISSING:
+                try:
+                    result = compute(user_input)
+                except Exception:
+                    self.errors.inc(search_type)
+                    raise
+                if result is not None and (
+                    timings is None or None not in timings.values()
+                ):
+                    self.result_cache.put(key, result)
+        self.count_empty(search_type, result)
+        return result
+
+    def count_empty(self, search_type, result):
+        if not any(
+            recommendations and recommendations.books
+            for recommendations in result or []
+        ):
+            self.empty_results.inc(search_type)
+
+    def suggestions(self, search_type, prefix, limit=SUGGESTIONS_COUNT):
+        """Completions of a partial input, best first; [] for other search types."""
+        with self.request_seconds.time("autocomplete"):
+            prefix_index = self.prefix_indexes.get(search_type)
+            if prefix_index is None:
+                return []
+            return prefix_index.suggest(prefix, limit)
+
+    def get_recommendations_by_book(self, book_name, timings=None):
         """Get final recommendations for a input book."""
+        if timings is None:
+            timings = {}
+        return self.cached_results(
+            "bookname",
+            book_name,
+            lambda name: self.find_recommendations_by_book(name, timings),
+            timings,
+        )
+
+    def find_recommendations_by_book(self, book_name, timings=None):
+        """Resolve the title once and run every strategy on its book id."""
         try:
-            final_recommendations = [
-                self.collaborative_recommendation(book_name),
-                self.recommend_books_by_author(book_name),
-                self.recommend_books_by_publisher(book_name),
-                self.recommendations_by_year(book_name),
-                self.recommendation_by_same_place(book_name),
-            ]
+            strategy_results = self.run_strategies(
+                [
+                    ("collaborative", self.collaborative_recommendations_for_ids),
+                    (
+                        "author",
+                        partial(
+                            self.recommend_books_for_ids, recommendation_type="author"
+                        ),
+                    ),
+                    (
+                        "publisher",
+                        partial(
+                            self.recommend_books_for_ids,
+                            recommendation_type="publisher",
+                        ),
+                    ),
+                    ("year", partial(self.recommendations_by_years, [book_name])),
+                    ("same_place", self.recommendations_by_same_places),
+                ],
+                [self.resolve_title(book_name)],
+                timings,
+            )
+            return self.final_recommendations(
+                [results[0] if results else None for results in strategy_results]
+            )
+        except KeyError as e:
+            self.record_error(
+                "get_recommendations_by_book",
+                f"Error in get_recommendations_by_book: {e}",
+            )
+
+    def final_recommendations(self, strategy_results):
+        final_recommendations = [
+            result for result in strategy_results if result and result.books
+        ]  # Remove None values and results without books
 
-            final_recommendations = [
-                result for result in final_recommendations if result and result.books
-            ]  # Remove None values and results without books
+        if not final_recommendations:
+            final_recommendations.append(
+                self.create_book_lists_helper("No books found!", [])
+            )
+        return final_recommendations
 
-            if not final_recommendations:
-                final_recommendations.append(
-                    self.create_book_lists_helper("No books found!", [])
+    def get_recommendations_by_books(self, book_names):
+        """Get final recommendations for many input books at once.
+
+        Cached results are reused. The remaining titles are resolved once each
+        and every strategy runs over all of them together, so titles sharing
+        an author, publisher, year or location share one lookup.
+        """
+        with self.request_seconds.time("bookname_batch"):
+            results = self.find_recommendations_by_books(book_names)
+        for result in results:
+            self.count_empty("bookname", result)
+        return results
+
+    def find_recommendations_by_books(self, book_names):
+        book_names = [str(book_name) for book_name in book_names]
+        results = {}
+        for book_name in dict.fromkeys(book_names):
+            cached = self.result_cache.get(self.cache_key("bookname", book_name))
+            if cached is not MISSING:
+                results[book_name] = cached
+
+        missing_names = [
+            book_name
+            for book_name in dict.fromkeys(book_names)
+            if book_name not in results
+        ]
+        if missing_names:
+            book_ids = [self.resolve_title(name) for name in missing_names]
+            strategy_results = zip(
+                self.collaborative_recommendations_for_ids(book_ids),
+                self.recommend_books_for_ids(book_ids, "author"),
+                self.recommend_books_for_ids(book_ids, "publisher"),
+                self.recommendations_by_years(missing_names, book_ids),
+                self.recommendations_by_same_places(book_ids),
+            )
+            for book_name, recommendations in zip(missing_names, strategy_results):
+                results[book_name] = self.final_recommendations(recommendations)
+                self.result_cache.put(
+                    self.cache_key("bookname", book_name), results[book_name]
                 )
 
-            return self.results_in_json(final_recommendations)
-        except KeyError as e:
-            print(f"Error in get_recommendations_by_book: {e}")
+        return [results[book_name] for book_name in book_names]
+
+    def search_books(
+        self,
+        author=None,
+        publisher=None,
+        country=None,
+        year_from=None,
+        year_to=None,
+        offset=0,
+        limit=FACET_PAGE_SIZE,
+    ):
+        """Books matching every given filter, best aggregated rating first.
+
+        Author, publisher and country must match a value exactly, ignoring case
+        and spacing; the publication year range includes both ends. Returns a
+        page of ``limit`` books from rank ``offset`` on, empty past the last
+        match, and the number of matching books.
+        """
+        filters = {"author": author, "publisher": publisher, "country": country}
+        # No book ranks past the catalogue, so larger offsets share its empty page
+        offset = min(max(int(offset), 0), len(self.book_titles))
+        limit = max(int(limit), 0)
+        with self.request_seconds.time("facets"):
+            key = (
+                self.artifact_version,
+                "facets",
+                tuple(
+                    None if value is None else TitleIndex.normalise(str(value))
+                    for value in filters.values()
+                ),
+                year_from,
+                year_to,
+                offset,
+                limit,
+            )
+            result = self.result_cache.get(key)
+            if result is MISSING:
+                result = self.find_books(filters, year_from, year_to, offset, limit)
+                self.result_cache.put(key, result)
+        self.count_empty("facets", [result[0]])
+        return result
+
+    def find_books(self, filters, year_from, year_to, offset, limit):
+        posting_lists = [
+            self.facet_books(facet, value)
+            for facet, value in filters.items()
+            if value is not None
+        ]
+        has_years = year_from is not None or year_to is not None
+        if posting_lists:
+            book_ids = intersect_sorted(posting_lists)
+            if has_years:
+                years = self.book_years[book_ids]
+                book_ids = book_ids[
+                    (year_from is None or years >= year_from)
+                    & (year_to is None or years <= year_to)
+                ]
+            page = smallest_page(book_ids, offset, limit, is_sorted=True)
+        elif has_years:
+            book_ids = self.year_index.books(year_from, year_to)
+            page = smallest_page(book_ids, offset, limit)
+        else:
+            book_ids = self.book_titles
+            page = np.arange(offset, min(offset + limit, len(book_ids)))
+
+        books_list = [self.create_book(book_id) for book_id in page]
+        if len(book_ids) == 0:
+            title = "Oops! No books match the filters"
+        else:
+            title = "Top books matching the filters"
+        return self.create_book_lists_helper(title, books_list), len(book_ids)
+
+    def facet_books(self, facet, value):
+        facet_index = self.facet_indexes.get(facet)
+        if facet_index is None:
+            return np.empty(0, dtype=np.int32)
+        return facet_index.books(value)
 
     def get_recommendations_by_author(self, author_name):
+        return self.cached_results(
+            "author", author_name, self.find_recommendations_by_author
+        )
+
+    def find_recommendations_by_author(self, author_name):
         final_recommendations = []
         final_recommendations.append(self.recommendation_by_given_author(author_name))
-        return self.results_in_json(final_recommendations)
+        return final_recommendations
 
     def get_recommendations_by_publisher(self, publisher_name):
+        return self.cached_results(
+            "publisher", publisher_name, self.find_recommendations_by_publisher
+        )
+
+    def find_recommendations_by_publisher(self, publisher_name):
         final_recommendations = []
         final_recommendations.append(
             self.recommendation_by_given_publisher(publisher_name)
         )
-        return self.results_in_json(final_recommendations)
+        return final_recommendations
 
     def get_recommendations_by_year(self, year):
+        return self.cached_results("year", year, self.find_recommendations_by_year)
+
+    def find_recommendations_by_year(self, year):
         final_recommendations = []
         final_recommendations.append(self.recommendations_by_year(year))
-        return self.results_in_json(final_recommendations)
+        return final_recommendations
 
     def get_recommendations_by_location(self, location):
+        return self.cached_results(
+            "location", location, self.find_recommendations_by_location
+        )
+
+    def find_recommendations_by_location(self, location):
         final_recommendations = []
         final_recommendations.append(self.recommendations_by_location(location))
-        return self.results_in_json(final_recommendations)
+        return final_recommendations
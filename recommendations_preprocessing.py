@@ -1,130 +1,618 @@
 """
 
 This file defines a class for preprocessing data for a recommendation system.
-It includes methods for loading datasets, handling missing values, saving dataframes to pickle
-files, and performing other preprocessing tasks.
+It includes methods for loading datasets, handling missing values, saving the served tables
+as a memory-mapped artifact version, and performing other preprocessing tasks.
+The steps run as cached pipeline stages, so unchanged stages are not recomputed.
 
 """
-import pickle
+import argparse
+import os
+import shutil
 import pandas as pd
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from pandas.api.types import union_categoricals
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from ann_index import RandomProjectionIndex
+from autocomplete import PrefixIndex, Vocabulary
+from artifact_store import ARTIFACTS_DIR, ArtifactStore, ArtifactWriter
+from facets import FacetIndex, RangeIndex
+from item_embeddings import EMBEDDING_DIMENSIONS, ItemEmbeddings
+from leaderboards import Leaderboard
+from pipeline import STAGE_CACHE_DIR, Pipeline, Stage
+from search_index import TitleIndex
+
+NEIGHBOURS_COUNT = 20
+MIN_USER_RATINGS = 200
+MIN_BOOK_RATINGS = 50
+# Books need this many explicit ratings to enter the catalogue-wide indexes
+CATALOGUE_MIN_BOOK_RATINGS = 5
+# Upper bound on the number of similarity scores held in memory at once
+SIMILARITY_BLOCK_ELEMENTS = 16_000_000
+CSV_CHUNK_ROWS = 250_000
+# Only the served columns are read; repeated strings are loaded as categoricals
+BOOKS_DTYPES = {
+    "ISBN": "category",
+    "Book-Title": "category",
+    "Book-Author": "category",
+    "Year-Of-Publication": str,
+    "Publisher": "category",
+    "Image-URL-M": "category",
+}
+RATINGS_DTYPES = {"User-ID": np.int32, "ISBN": str, "Book-Rating": np.int8}
+USERS_DTYPES = {"User-ID": np.int32, "Location": "category", "Age": np.float32}
+# Columns the server reads for every book and for the top books of the home page
+CATALOGUE_COLUMNS = [
+    "Book-Title",
+    "Book-Author",
+    "Publisher",
+    "Year-Of-Publication",
+    "Image-URL-M",
+]
+TOP_BOOKS_COLUMNS = ["Book-Title", "Book-Author", "Image-URL-M"]
+PLACE_COLUMNS = ["City", "State", "Country"]
+# Catalogue columns suggested while typing, and the artifacts they go to
+SUGGESTED_COLUMNS = {
+    "Book-Title": "title_suggestions",
+    "Book-Author": "author_suggestions",
+    "Publisher": "publisher_suggestions",
+}
 
 
 class RecommendationsPreprocessing:
-    def __init__(self):
-        self.df_books = self.load_csv("Dataset/Books.csv")
-        self.df_ratings = self.load_csv("Dataset/Ratings.csv")
-        self.df_users = self.load_csv("Dataset/Users.csv")
+    def __init__(
+        self,
+        min_user_ratings=MIN_USER_RATINGS,
+        min_book_ratings=MIN_BOOK_RATINGS,
+        artifacts_dir=ARTIFACTS_DIR,
+        catalogue_min_book_ratings=CATALOGUE_MIN_BOOK_RATINGS,
+        embedding_dimensions=EMBEDDING_DIMENSIONS,
+        stage_cache_dir=STAGE_CACHE_DIR,
+        workers=None,
+    ):
+        self.min_user_ratings = min_user_ratings
+        self.min_book_ratings = min_book_ratings
+        self.artifacts_dir = artifacts_dir
+        self.catalogue_min_book_ratings = catalogue_min_book_ratings
+        self.embedding_dimensions = embedding_dimensions
+        self.stage_cache_dir = stage_cache_dir
+        self.workers = workers
+        self.books_path = "Dataset/Books.csv"
+        self.ratings_path = "Dataset/Ratings.csv"
+        # Ratings folded in by update_with_ratings, kept for full runs to read;
+        # they live with the artifacts, outside the tracked dataset
+        self.rating_deltas_dir = os.path.join(artifacts_dir, "rating_deltas")
+        self.users_path = "Dataset/Users.csv"
+        self.df_books = pd.DataFrame()
+        self.df_users = pd.DataFrame()
         self.df_recommendation_dataset = pd.DataFrame()
         self.df_top_books = pd.DataFrame()
         self.author_recommendations_df = pd.DataFrame()
         self.pivot_table_df = pd.DataFrame()
         self.similarity_scores_df = []
 
-    def load_csv(self, file_path):
+    def read_csv_chunks(self, file_path, dtypes):
+        """Yield a CSV file in chunks of CSV_CHUNK_ROWS rows with the given dtypes."""
         try:
-            return pd.read_csv(file_path, low_memory=False)
+            with pd.read_csv(
+                file_path, usecols=list(dtypes), dtype=dtypes, chunksize=CSV_CHUNK_ROWS
+            ) as reader:
+                yield from reader
         except FileNotFoundError as e:
             print(f"Error loading dataset at {file_path}: {e}")
+
+    def load_csv(self, file_path, dtypes):
+        chunks = list(self.read_csv_chunks(file_path, dtypes))
+        if not chunks:
             return None
 
-    def handle_missing_values(self, df, column, default_value):
-        null_indices = np.where(df[column].isnull())[0]
-        for index in null_indices:
-            df.at[index, column] = default_value
+        # Chunks carry their own categories; unify them before concatenating
+        categorical_columns = {
+            column: union_categoricals(
+                [chunk[column] for chunk in chunks], sort_categories=True
+            )
+            for column, dtype in dtypes.items()
+            if dtype == "category"
+        }
+        df = pd.concat(
+            [chunk.drop(columns=list(categorical_columns)) for chunk in chunks],
+            ignore_index=True,
+        )
+        for column, values in categorical_columns.items():
+            df[column] = values
+        return df[list(dtypes)]
 
-    def save_dataframe_to_pickle(self, dataframe, filename):
-        with open(filename, "wb") as file:
-            pickle.dump(dataframe, file)
+    def add_categories(self, df, column, values):
+        """Let a categorical column accept values that are not categories yet."""
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            new_values = pd.Index(values).difference(df[column].cat.categories)
+            df[column] = df[column].cat.add_categories(new_values)
 
-    def preprocess_data(self):
-        self.handle_missing_values(self.df_books, ["Book-Author", "Publisher"], "Other")
-
-        # dropping unrequired columns in books dataset
-        self.df_books.drop(["Image-URL-S", "Image-URL-L"], axis=1, inplace=True)
-        self.df_books["ISBN"].str.upper()
-
-        # Replacing null author and publisher with other
-        null_author = np.where(self.df_books["Book-Author"].isnull())
-        null_publisher = np.where(self.df_books["Publisher"].isnull())
-        self.df_books.at[null_author[0][0], "Book-Author"] = "Other"
-        self.df_books.at[null_publisher[0][0], "Publisher"] = "Other"
-        self.df_books.at[null_publisher[0][1], "Publisher"] = "Other"
-
-        # Editing data for specific cases
-        cases_to_edit = [
-            (209538, "Other", 2000, "DK Publishing Inc"),
-            (221678, "Other", 2000, "DK Publishing Inc"),
-            (220731, "Other", "2003", "Gallimard"),
+    def handle_missing_values(self, df, columns, default_value):
+        for column in columns:
+            self.add_categories(df, column, [default_value])
+        df[columns] = df[columns].fillna(default_value)
+
+    def build_rating_matrix(self, df_ratings):
+        """Build a sparse book x user matrix of mean ratings, one row per title."""
+        ratings = df_ratings.groupby(["Book-Title", "User-ID"], observed=True)[
+            "Book-Rating"
+        ].mean()
+        book_codes, book_titles = pd.factorize(
+            ratings.index.get_level_values("Book-Title"), sort=True
+        )
+        user_codes, user_ids = pd.factorize(
+            ratings.index.get_level_values("User-ID"), sort=True
+        )
+        rating_matrix = sparse.csr_matrix(
+            (ratings.to_numpy(dtype=np.float32), (book_codes, user_codes)),
+            shape=(len(book_titles), len(user_ids)),
+        )
+        rating_matrix.eliminate_zeros()
+        return rating_matrix, book_titles, user_ids
+
+    def top_k_neighbours(self, similarity_scores, k=NEIGHBOURS_COUNT, offset=0):
+        """Keep the k most similar books of every row, best first, excluding itself.
+
+        ``similarity_scores`` may be a block of rows starting at book ``offset``.
+        """
+        similarity_scores = np.array(similarity_scores, dtype=np.float32)
+        rows = np.arange(similarity_scores.shape[0])
+        similarity_scores[rows, rows + offset] = -np.inf
+        k = min(k, similarity_scores.shape[1] - 1)
+        if k <= 0:
+            return (
+                np.empty((similarity_scores.shape[0], 0), dtype=np.int32),
+                np.empty((similarity_scores.shape[0], 0), dtype=np.float32),
+            )
+
+        candidate_ids = np.argpartition(-similarity_scores, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(similarity_scores, candidate_ids, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind="stable")
+        neighbour_ids = np.take_along_axis(candidate_ids, order, axis=1)
+        neighbour_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        return neighbour_ids.astype(np.int32), neighbour_scores
+
+    def similar_books(self, rating_matrix, k=NEIGHBOURS_COUNT):
+        """Compute the cosine top-k neighbours of every row of a sparse matrix.
+
+        Rows are processed in blocks so that only a bounded slice of the
+        similarity matrix exists at any time.
+        """
+        books_count = rating_matrix.shape[0]
+        if books_count == 0:
+            return self.top_k_neighbours(np.empty((0, 0)), k)
+        normalized_matrix = normalize(rating_matrix, norm="l2", axis=1)
+        normalized_transposed = normalized_matrix.T.tocsr()
+        block_size = max(1, SIMILARITY_BLOCK_ELEMENTS // max(books_count, 1))
+
+        neighbour_blocks = []
+        for start in range(0, books_count, block_size):
+            block = (
+                normalized_matrix[start : start + block_size] @ normalized_transposed
+            )
+            neighbour_blocks.append(
+                self.top_k_neighbours(block.toarray(), k, offset=start)
+            )
+
+        neighbour_ids, neighbour_scores = zip(*neighbour_blocks)
+        return np.vstack(neighbour_ids), np.vstack(neighbour_scores)
+
+    def build_title_texts(self, df_books):
+        """Index every distinct title of the books dataset, before any ranking."""
+        return TitleIndex(df_books["Book-Title"].cat.categories)
+
+    def build_vocabularies(self, df_books):
+        """Prepare the suggested columns of the books dataset for ranking."""
+        return {
+            column: Vocabulary(df_books[column].cat.categories)
+            for column in SUGGESTED_COLUMNS
+        }
+
+    def build_title_index(self, title_texts, author_table):
+        # Ranked titles share the categories of the books dataset
+        return title_texts.select(author_table["Book-Title"].cat.codes)
+
+    def place_ratings(self, df_ratings):
+        """Lowercased city, state and country of every rating, by column.
+
+        Locations are lowercased once per category instead of once per rating,
+        and the columns share their categories, so they concatenate cheaply.
+        """
+        places = [df_ratings[column].cat for column in PLACE_COLUMNS]
+        categories = (
+            pd.Index(np.concatenate([place.categories.str.lower() for place in places]))
+            .unique()
+            .sort_values()
+        )
+        return {
+            column: pd.Categorical.from_codes(
+                np.append(categories.get_indexer(place.categories.str.lower()), -1)[
+                    place.codes
+                ],
+                categories=categories,
+            )
+            for column, place in zip(PLACE_COLUMNS, places)
+        }
+
+    def build_leaderboards(self, joined_ratings, author_table):
+        """Rank the best rated books per publication year and per location."""
+        df_recommendation_dataset, _, _ = joined_ratings
+        book_ids = pd.Index(author_table["Book-Title"]).get_indexer(
+            df_recommendation_dataset["Book-Title"]
+        )
+        book_ratings = df_recommendation_dataset["Book-Rating"].to_numpy()
+
+        df_year_ratings = pd.DataFrame(
+            {
+                "Year-Of-Publication": df_recommendation_dataset[
+                    "Year-Of-Publication"
+                ].to_numpy(),
+                "Book-Id": book_ids,
+                "Book-Rating": book_ratings,
+            }
+        )
+        # A location query matches the city, the state or the country of a user
+        df_place_ratings = pd.concat(
+            [
+                pd.DataFrame(
+                    {"Place": places, "Book-Id": book_ids, "Book-Rating": book_ratings}
+                )
+                for places in self.place_ratings(df_recommendation_dataset).values()
+            ],
+            ignore_index=True,
+        )
+        return {
+            "year_leaderboard": Leaderboard.build(
+                df_year_ratings, "Year-Of-Publication"
+            ),
+            "place_leaderboard": Leaderboard.build(df_place_ratings, "Place"),
+        }
+
+    def build_catalogue_suggestions(self, vocabularies, author_table):
+        """Index titles, authors and publishers for autocompletion.
+
+        Titles rank by aggregated rating, authors and publishers by the total
+        aggregated rating of their books. The "Other" placeholder of missing
+        values is never suggested.
+        """
+        aggregated_ratings = author_table["Aggregated-Rating"]
+        prefix_indexes = {
+            "title_suggestions": vocabularies["Book-Title"].rank(
+                author_table["Book-Title"].cat.codes, aggregated_ratings
+            )
+        }
+        for column in ["Book-Author", "Publisher"]:
+            totals = aggregated_ratings.groupby(author_table[column].astype(str)).sum()
+            totals = totals[totals.index != "Other"]
+            prefix_indexes[SUGGESTED_COLUMNS[column]] = vocabularies[column].rank(
+                author_table[column].cat.categories.get_indexer(totals.index), totals
+            )
+        return prefix_indexes
+
+    def build_location_suggestions(self, joined_ratings):
+        """Index the rating locations for autocompletion, by ratings count."""
+        df_recommendation_dataset, _, _ = joined_ratings
+        places = sum(
+            pd.Series(places).value_counts(sort=False)
+            for places in self.place_ratings(df_recommendation_dataset).values()
+        )
+        places = places[(places.index != "other") & (places > 0)]
+        return PrefixIndex.build(places.index, places)
+
+    def build_catalogue(self, author_table):
+        """Keep only the served columns of the ranked books, one row per book id."""
+        catalogue = author_table[CATALOGUE_COLUMNS].reset_index(drop=True)
+        # Cleaned publication years fit in two bytes
+        catalogue["Year-Of-Publication"] = pd.to_numeric(
+            catalogue["Year-Of-Publication"], downcast="integer"
+        )
+        return catalogue
+
+    def build_book_places(self, joined_ratings, author_table):
+        """Lowercased location of the first rating of every book, one row per book id.
+
+        Books without a rating get missing values.
+        """
+        df_recommendation_dataset, _, _ = joined_ratings
+        first_ratings = df_recommendation_dataset.drop_duplicates("Book-Title")
+        rating_rows = pd.Index(first_ratings["Book-Title"].values).get_indexer(
+            author_table["Book-Title"]
+        )
+        is_rated = rating_rows >= 0
+        book_places = {}
+        for column in PLACE_COLUMNS:
+            places = first_ratings[column].astype(str).str.lower().to_numpy()
+            book_places[column] = pd.Categorical(
+                np.where(is_rated, places[rating_rows], None)
+            )
+        return pd.DataFrame(book_places)
+
+    def build_catalogue_facets(self, author_table):
+        """Index the books by author and publisher, and by year."""
+        catalogue = self.build_catalogue(author_table)
+        book_ids = np.arange(len(catalogue), dtype=np.int32)
+        return {
+            "author_facet": FacetIndex.build(catalogue["Book-Author"], book_ids),
+            "publisher_facet": FacetIndex.build(catalogue["Publisher"], book_ids),
+            "year_index": RangeIndex.build(catalogue["Year-Of-Publication"]),
+        }
+
+    def build_country_facet(self, joined_ratings, author_table):
+        """Index the books by rating country; a book belongs to every country
+        one of its ratings came from."""
+        df_recommendation_dataset, _, _ = joined_ratings
+        countries = df_recommendation_dataset["Country"].cat
+        country_codes = countries.codes.to_numpy().astype(np.int64)
+        book_ids = pd.Index(author_table["Book-Title"]).get_indexer(
+            df_recommendation_dataset["Book-Title"]
+        )
+        is_known = (country_codes >= 0) & (book_ids >= 0)
+        # Each country and book pair is indexed once, however many ratings it has
+        books_count = max(len(author_table), 1)
+        pairs = np.unique(country_codes[is_known] * books_count + book_ids[is_known])
+        return FacetIndex.build(
+            countries.categories[pairs // books_count], pairs % books_count
+        )
+
+    def vocabulary_stages(self):
+        """Stages preparing the text of the books dataset for the indexes.
+
+        They do not read the ratings, so updates load them from the stage cache
+        and only rank what they prepared.
+        """
+        return [
+            Stage("title_texts", self.build_title_texts, inputs=["clean_books"]),
+            Stage("vocabularies", self.build_vocabularies, inputs=["clean_books"]),
+        ]
+
+    def index_stages(self):
+        """Stages building the served indexes from the ranked books and ratings."""
+        return [
+            Stage(
+                "title_index",
+                self.build_title_index,
+                inputs=["title_texts", "author_table"],
+            ),
+            Stage(
+                "catalogue_suggestions",
+                self.build_catalogue_suggestions,
+                inputs=["vocabularies", "author_table"],
+            ),
+            Stage(
+                "catalogue_facets",
+                self.build_catalogue_facets,
+                inputs=["author_table"],
+            ),
+            # These read the joined ratings, so they stay in this process
+            Stage(
+                "location_suggestions",
+                self.build_location_suggestions,
+                inputs=["join"],
+                in_process=True,
+            ),
+            Stage(
+                "country_facet",
+                self.build_country_facet,
+                inputs=["join", "author_table"],
+                in_process=True,
+            ),
+            Stage(
+                "leaderboards",
+                self.build_leaderboards,
+                inputs=["join", "author_table"],
+                in_process=True,
+            ),
+            Stage(
+                "book_places",
+                self.build_book_places,
+                inputs=["join", "author_table"],
+                in_process=True,
+            ),
         ]
 
-        for case in cases_to_edit:
-            index, author_value, year_value, publisher_value = case
-            try:
-                self.df_books.at[index, "Book-Author"] = author_value
-                self.df_books.at[index, "Year-Of-Publication"] = year_value
-                self.df_books.at[index, "Publisher"] = publisher_value
-            except KeyError as e:
-                print(f"Error editing data for index {index}: {e}")
+    def save_artifacts(self, outputs):
+        """Write the served tables and indexes as a new artifact version.
+
+        ``outputs`` holds the outputs of the preprocessing stages by stage
+        name. Book ids used by the server are row positions in the written
+        catalogue table.
+        """
+        author_table = outputs["author_table"].reset_index(drop=True)
+        df_recommendation_dataset, title_totals, _ = outputs["join"]
+        rating_matrix, collaborative_titles, collaborative_user_ids = outputs[
+            "collaborative_matrix"
+        ]
+        neighbour_ids, neighbour_scores = outputs["similarity"]
+        _, catalogue_titles, _ = outputs["catalogue_matrix"]
+        book_ids_by_title = pd.Index(author_table["Book-Title"])
+
+        writer = ArtifactWriter(self.artifacts_dir)
+        # Read back by incremental updates only; the server is answered from
+        # the per-book tables and the leaderboards aggregated from it
+        writer.write_table("books_with_ratings", df_recommendation_dataset)
+        writer.write_table("title_totals", title_totals.reset_index())
+        writer.write_table("catalogue", self.build_catalogue(author_table))
+        writer.write_table(
+            "top_books",
+            outputs["popularity"][:50][TOP_BOOKS_COLUMNS].reset_index(drop=True),
+        )
+        writer.write_strings("collaborative_titles", collaborative_titles)
+        writer.write_array("collaborative_user_ids", np.asarray(collaborative_user_ids))
+        writer.write_array("rating_matrix.data", rating_matrix.data)
+        writer.write_array("rating_matrix.indices", rating_matrix.indices)
+        writer.write_array("rating_matrix.indptr", rating_matrix.indptr)
+        writer.write_array("neighbour_ids", neighbour_ids)
+        writer.write_array("neighbour_scores", neighbour_scores)
+        writer.write_array(
+            "collaborative_book_ids",
+            book_ids_by_title.get_indexer(collaborative_titles).astype(np.int32),
+        )
+        writer.write_table("book_places", outputs["book_places"])
+        writer.write_array(
+            "catalogue_book_ids",
+            book_ids_by_title.get_indexer(catalogue_titles).astype(np.int32),
+        )
+        outputs["ann_index"].write(writer)
+        outputs["item_embeddings"].write(writer)
+        outputs["title_index"].write(writer)
+        outputs["location_suggestions"].write(writer, "location_suggestions")
+        outputs["country_facet"].write(writer, "country_facet")
+        for stage in ["leaderboards", "catalogue_suggestions", "catalogue_facets"]:
+            for name, index in outputs[stage].items():
+                index.write(writer, name)
+        return writer.commit()
+
+    def clean_books(self, books_path):
+        """Load the books dataset and clean it."""
+        df_books = self.load_csv(books_path, BOOKS_DTYPES)
+        self.handle_missing_values(df_books, ["Book-Author", "Publisher"], "Other")
+
+        # Editing data for specific cases; years are still strings here
+        cases_to_edit = pd.DataFrame(
+            [
+                (209538, "Other", "2000", "DK Publishing Inc"),
+                (221678, "Other", "2000", "DK Publishing Inc"),
+                (220731, "Other", "2003", "Gallimard"),
+            ],
+            columns=["Index", "Book-Author", "Year-Of-Publication", "Publisher"],
+        ).set_index("Index")
+        cases_to_edit = cases_to_edit[cases_to_edit.index.isin(df_books.index)]
+        for column in ["Book-Author", "Publisher"]:
+            self.add_categories(df_books, column, cases_to_edit[column])
+        df_books.loc[cases_to_edit.index, cases_to_edit.columns] = cases_to_edit
 
         # Converting year of publication to int and cleaning invalid years
-        self.df_books["Year-Of-Publication"] = pd.to_numeric(
-            self.df_books["Year-Of-Publication"], errors="coerce"
+        df_books["Year-Of-Publication"] = pd.to_numeric(
+            df_books["Year-Of-Publication"], errors="coerce"
         )
-        self.df_books.loc[
-            self.df_books["Year-Of-Publication"] > 2022, "Year-Of-Publication"
-        ] = 2002
-        self.df_books.loc[
-            self.df_books["Year-Of-Publication"] == 0, "Year-Of-Publication"
+        df_books.loc[
+            df_books["Year-Of-Publication"] > 2022, "Year-Of-Publication"
         ] = 2002
+        df_books.loc[df_books["Year-Of-Publication"] == 0, "Year-Of-Publication"] = 2002
+        return df_books
+
+    def clean_users(self, users_path):
+        """Load the users dataset and split locations into city, state and country."""
+        df_users = self.load_csv(users_path, USERS_DTYPES)
+
+        # Locations are cleaned once per distinct value, then mapped to users
+        locations = df_users["Location"].cat
+        places = (
+            locations.categories.to_series()
+            .str.split(", ", expand=True)
+            .reindex(columns=range(3))
+        )
+        for position, column in enumerate(["City", "State", "Country"]):
+            place = places[position]
+            place = place.str.lower().where(
+                place.notna() & ~place.isin(["", "n/a", " "]), "Other"
+            )
+            # Users without a location have code -1, which picks the final "Other"
+            df_users[column] = pd.Categorical(
+                np.append(place.to_numpy(dtype=object), "Other")[locations.codes]
+            )
+        df_users.drop(["Location"], axis=1, inplace=True)
+
+        age_mask = (df_users["Age"] >= 8) & (df_users["Age"] <= 98)
+        average_age = round(df_users.loc[age_mask, "Age"].mean())
+        df_users["Age"] = df_users["Age"].fillna(average_age).astype(int)
+        return df_users
+
+    def rating_delta_paths(self):
+        """CSVs of the ratings folded in so far, in the order they were folded."""
+        if not os.path.isdir(self.rating_deltas_dir):
+            return []
+        return [
+            os.path.join(self.rating_deltas_dir, filename)
+            for filename in sorted(os.listdir(self.rating_deltas_dir))
+            if filename.endswith(".csv")
+        ]
+
+    def join_ratings(self, df_books, df_users, ratings_path, delta_paths=()):
+        """Join ratings CSVs with the cleaned books and users, chunk by chunk.
 
-        self.df_users[["City", "State", "Country"]] = self.df_users[
-            "Location"
-        ].str.split(
-            ", ", expand=True
-        )  # Splitting location into city, state and country
-        self.df_users[["City", "State", "Country"]] = self.df_users[
-            ["City", "State", "Country"]
-        ].applymap(
-            lambda x: "Other" if pd.isnull(x) or x in ["", "n/a", " "] else x.lower()
+        The ratings of ``delta_paths`` are read after those of ``ratings_path``.
+        Only one chunk is expanded at a time; the per-title and per-user
+        totals are accumulated on the way. Returns the joined dataset, in the
+        order a single merge of books and ratings produces, and the totals.
+        """
+        df_books = df_books.reset_index(names="Book-Row")
+        joined_chunks, title_totals, user_counts = [], [], []
+        chunks = (
+            df_ratings
+            for path in [ratings_path, *delta_paths]
+            for df_ratings in self.read_csv_chunks(path, RATINGS_DTYPES)
         )
-        self.df_users.drop(["Location"], axis=1, inplace=True)
+        for df_ratings in chunks:
+            df_ratings = df_ratings.assign(
+                ISBN=pd.Categorical(df_ratings["ISBN"], dtype=df_books["ISBN"].dtype)
+            ).dropna(subset=["ISBN"])
+            df_joined = pd.merge(df_books, df_ratings, on="ISBN")
+            df_joined = pd.merge(df_joined, df_users, on="User-ID")
+            joined_chunks.append(df_joined)
+            title_totals.append(self.rating_totals(df_joined))
+            user_counts.append(df_joined["User-ID"].value_counts())
 
-        age_mask = (self.df_users["Age"] >= 8) & (self.df_users["Age"] <= 98)
-        average_age = round(self.df_users.loc[age_mask, "Age"].mean())
-        self.df_users["Age"] = self.df_users["Age"].fillna(average_age).astype(int)
+        if not joined_chunks:
+            return None, None, None
 
-        df_recommendation_dataset = pd.merge(self.df_books, self.df_ratings, on="ISBN")
-        df_recommendation_dataset = pd.merge(
-            df_recommendation_dataset, self.df_users, on="User-ID"
+        df_recommendation_dataset = (
+            pd.concat(joined_chunks, ignore_index=True)
+            .sort_values("Book-Row", kind="stable")
+            .drop(columns="Book-Row")
+            .reset_index(drop=True)
         )
+        title_totals = self.sum_totals(title_totals)
+        user_counts = pd.concat(user_counts).groupby(level=0).sum()
+        return df_recommendation_dataset, title_totals, user_counts
 
-        self.save_dataframe_to_pickle(
-            self.df_recommendation_dataset, "pklFiles/books_with_ratings.pkl"
+    def rating_totals(self, df_ratings):
+        """Per-title count and sum of all ratings and of explicit (non-zero) ones."""
+        ratings = df_ratings["Book-Rating"].astype(np.int64)
+        explicit_ratings = ratings.where(ratings != 0)
+        return (
+            pd.DataFrame(
+                {
+                    "Book-Title": df_ratings["Book-Title"],
+                    "count": ratings,
+                    "sum": ratings,
+                    "explicit_count": explicit_ratings,
+                    "explicit_sum": explicit_ratings,
+                }
+            )
+            .groupby("Book-Title", observed=True)
+            .agg(
+                {
+                    "count": "count",
+                    "sum": "sum",
+                    "explicit_count": "count",
+                    "explicit_sum": "sum",
+                }
+            )
         )
 
-        df_books_with_ratings = df_recommendation_dataset[
-            df_recommendation_dataset["Book-Rating"] != 0
-        ]
-        df_books_with_ratings = df_books_with_ratings.reset_index(drop=True)
+    def sum_totals(self, title_totals):
+        """Add up per-title totals, such as those of several rating chunks."""
+        return pd.concat(title_totals).groupby(level=0, observed=True).sum()
+
+    def compute_top_books(self, joined_ratings, df_books):
+        _, title_totals, _ = joined_ratings
+        rated_totals = title_totals[title_totals["explicit_count"] > 0]
 
         # Calculating total number of ratings for each book
         df_ratings_count = (
-            df_books_with_ratings.groupby("Book-Title")
-            .count()["Book-Rating"]
-            .reset_index()
+            rated_totals["explicit_count"].rename("Book-Rating").reset_index()
         )
         df_ratings_count = df_ratings_count.sort_values("Book-Rating", ascending=False)
 
         df_average_rating = (
-            df_books_with_ratings.groupby("Book-Title")
-            .mean(numeric_only=True)["Book-Rating"]
+            (rated_totals["explicit_sum"] / rated_totals["explicit_count"])
+            .rename("Average-Rating")
             .reset_index()
         )
-        df_average_rating.rename(
-            columns={"Book-Rating": "Average-Rating"}, inplace=True
-        )
         df_average_rating = df_average_rating.sort_values(
             "Average-Rating", ascending=False
         )
@@ -140,9 +628,9 @@ class RecommendationsPreprocessing:
             "Average-Rating", ascending=False
         )  # Filter to consider total-ratings atleast more than 200
 
-        df_top_books = df_top_books.merge(
-            self.df_books, on="Book-Title"
-        ).drop_duplicates("Book-Title")[
+        df_top_books = df_top_books.merge(df_books, on="Book-Title").drop_duplicates(
+            "Book-Title"
+        )[
             [
                 "Book-Title",
                 "Book-Author",
@@ -152,25 +640,25 @@ class RecommendationsPreprocessing:
             ]
         ]
         df_top_books.reset_index(inplace=True)
+        return df_top_books
+
+    def build_author_recommendations(self, joined_ratings, df_books):
+        """Rank every rated book by its aggregated rating (count x average)."""
+        _, title_totals, _ = joined_ratings
 
         # Calculating ratings count on all books
         df_total_ratings_count = (
-            self.df_recommendation_dataset.groupby("Book-Title")
-            .count()["Book-Rating"]
-            .reset_index()
+            title_totals["count"].rename("Book-Rating").reset_index()
         )
         df_total_ratings_count = df_total_ratings_count.sort_values(
             "Book-Rating", ascending=False
         )
 
         df_average_books_rating = (
-            df_recommendation_dataset.groupby("Book-Title")
-            .mean(numeric_only=True)["Book-Rating"]
+            (title_totals["sum"] / title_totals["count"])
+            .rename("Average-Rating")
             .reset_index()
         )
-        df_average_books_rating.rename(
-            columns={"Book-Rating": "Average-Rating"}, inplace=True
-        )
 
         df_all_books = df_total_ratings_count.merge(
             df_average_books_rating, on="Book-Title"
@@ -186,26 +674,32 @@ class RecommendationsPreprocessing:
         )
 
         author_recommendations_df = author_recommendations_df.merge(
-            self.df_books, on="Book-Title"
+            df_books, on="Book-Title"
         ).drop_duplicates("Book-Title")
-        author_recommendations_df = author_recommendations_df.sort_values(
+        return author_recommendations_df.sort_values(
             "Aggregated-Rating", ascending=False
         )
 
-        # Fetching experienced users who have rated at least 200 books
-        collaborative_user_data = (
-            df_recommendation_dataset.groupby("User-ID").count()["Book-Rating"] > 200
-        )
+    def build_collaborative_matrix(
+        self, joined_ratings, min_user_ratings, min_book_ratings
+    ):
+        """Build the rating matrix of experienced users and well-rated books."""
+        df_recommendation_dataset, _, user_counts = joined_ratings
+
+        # Fetching experienced users who have rated more than min_user_ratings books
+        collaborative_user_data = user_counts > min_user_ratings
         experienced_users = collaborative_user_data[collaborative_user_data].index
 
         df_filtered_collaborative_data = df_recommendation_dataset[
             df_recommendation_dataset["User-ID"].isin(experienced_users)
         ]
 
-        # Fetching books with minimum 50 ratings by users
+        # Fetching books with more than min_book_ratings ratings by those users
         collaborative_rating_data = (
-            df_filtered_collaborative_data.groupby("Book-Title").count()["Book-Rating"]
-            > 50
+            df_filtered_collaborative_data.groupby("Book-Title", observed=True).count()[
+                "Book-Rating"
+            ]
+            > min_book_ratings
         )
         books_with_experienced_ratings = collaborative_rating_data[
             collaborative_rating_data
@@ -215,29 +709,386 @@ class RecommendationsPreprocessing:
                 books_with_experienced_ratings
             )
         ]
+        return self.build_rating_matrix(df_final_collaborative_data)
+
+    def collaborative_similarity(self, collaborative_matrix):
+        rating_matrix, _, _ = collaborative_matrix
+        return self.similar_books(rating_matrix)
+
+    def build_catalogue_matrix(self, joined_ratings, min_book_ratings):
+        """Build the explicit rating matrix of every book rated often enough.
+
+        Unlike the collaborative matrix it is not limited to experienced users,
+        so the indexes built from it cover the whole catalogue.
+        """
+        df_recommendation_dataset, title_totals, _ = joined_ratings
+        indexed_titles = title_totals.index[
+            title_totals["explicit_count"] >= min_book_ratings
+        ]
+        df_explicit_ratings = df_recommendation_dataset[
+            (df_recommendation_dataset["Book-Rating"] > 0)
+            & df_recommendation_dataset["Book-Title"].isin(indexed_titles)
+        ]
+        return self.build_rating_matrix(df_explicit_ratings)
+
+    def build_ann_index(self, catalogue_matrix):
+        rating_matrix, _, _ = catalogue_matrix
+        return RandomProjectionIndex.build(rating_matrix)
+
+    def build_item_embeddings(self, catalogue_matrix, dimensions):
+        rating_matrix, _, _ = catalogue_matrix
+        return ItemEmbeddings.build(rating_matrix, dimensions)
+
+    def cleaning_stages(self):
+        return [
+            Stage(
+                "clean_books",
+                self.clean_books,
+                arguments=[self.books_path],
+                files=[self.books_path],
+            ),
+            Stage(
+                "clean_users",
+                self.clean_users,
+                arguments=[self.users_path],
+                files=[self.users_path],
+            ),
+        ]
+
+    def preprocess_data(self):
+        """Run the preprocessing stages and write a new artifact version.
+
+        Stages whose inputs did not change since the previous run are loaded
+        from the stage cache.
+        """
+        delta_paths = self.rating_delta_paths()
+        stages = self.cleaning_stages() + [
+            Stage(
+                "join",
+                self.join_ratings,
+                inputs=["clean_books", "clean_users"],
+                arguments=[self.ratings_path, delta_paths],
+                files=[self.ratings_path, *delta_paths],
+            ),
+            # The stages reading the joined ratings share this process's copy
+            # instead of each receiving a pickled one in a worker
+            Stage(
+                "popularity",
+                self.compute_top_books,
+                inputs=["join", "clean_books"],
+                in_process=True,
+            ),
+            Stage(
+                "author_table",
+                self.build_author_recommendations,
+                inputs=["join", "clean_books"],
+                in_process=True,
+            ),
+            Stage(
+                "collaborative_matrix",
+                self.build_collaborative_matrix,
+                inputs=["join"],
+                arguments=[self.min_user_ratings, self.min_book_ratings],
+                in_process=True,
+            ),
+            Stage(
+                "similarity",
+                self.collaborative_similarity,
+                inputs=["collaborative_matrix"],
+            ),
+            Stage(
+                "catalogue_matrix",
+                self.build_catalogue_matrix,
+                inputs=["join"],
+                arguments=[self.catalogue_min_book_ratings],
+                in_process=True,
+            ),
+            Stage("ann_index", self.build_ann_index, inputs=["catalogue_matrix"]),
+            Stage(
+                "item_embeddings",
+                self.build_item_embeddings,
+                inputs=["catalogue_matrix"],
+                arguments=[self.embedding_dimensions],
+            ),
+        ]
+        outputs = Pipeline(
+            stages + self.vocabulary_stages() + self.index_stages(),
+            self.stage_cache_dir,
+            self.workers,
+        ).run()
+
+        self.df_books = outputs["clean_books"]
+        self.df_users = outputs["clean_users"]
+        self.df_recommendation_dataset = outputs["join"][0]
+        self.df_top_books = outputs["popularity"]
+        return self.save_artifacts(outputs)
+
+    def fold_ratings(self, df_ratings, df_new_ratings, df_books):
+        """Merge newly joined ratings into the stored joined ratings.
+
+        The stored categoricals only kept their used categories, so they are
+        recoded to those of the newly joined ratings, the categories of the
+        books and users; every column then has the dtype of a full run. Rows
+        come out in the order a full run over both produces: by book row, with
+        the new ratings of a book after its earlier ones.
+        """
+        df_ratings = pd.concat(
+            [df_ratings.astype(df_new_ratings.dtypes.to_dict()), df_new_ratings],
+            ignore_index=True,
+        )
+        isbns = df_books["ISBN"].cat
+        # A rating is joined to the first book row with its ISBN
+        book_rows = np.empty(len(isbns.categories), dtype=np.int64)
+        book_rows[isbns.codes.to_numpy()[::-1]] = np.arange(len(df_books))[::-1]
+        order = np.argsort(
+            book_rows[df_ratings["ISBN"].cat.codes.to_numpy()], kind="stable"
+        )
+        return df_ratings.take(order).reset_index(drop=True)
+
+    def update_rating_matrix(
+        self,
+        rating_matrix,
+        collaborative_titles,
+        collaborative_user_ids,
+        df_new_ratings,
+    ):
+        """Write new ratings into the collaborative matrix.
+
+        Only ratings of books and users already in the matrix are applied, and a
+        new rating replaces the previous one of the same user for the same book.
+        Returns the updated matrix and the rows that changed.
+        """
+        book_codes = pd.Index(collaborative_titles).get_indexer(
+            df_new_ratings["Book-Title"]
+        )
+        user_codes = pd.Index(collaborative_user_ids).get_indexer(
+            df_new_ratings["User-ID"]
+        )
+        in_matrix = (book_codes >= 0) & (user_codes >= 0)
+        new_entries = (
+            pd.DataFrame(
+                {
+                    "row": book_codes[in_matrix],
+                    "column": user_codes[in_matrix],
+                    "rating": df_new_ratings["Book-Rating"].to_numpy()[in_matrix],
+                }
+            )
+            .groupby(["row", "column"], as_index=False)["rating"]
+            .mean()
+        )
+
+        old_entries = rating_matrix.tocoo()
+        entries = pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        "row": old_entries.row,
+                        "column": old_entries.col,
+                        "rating": old_entries.data,
+                    }
+                ),
+                new_entries,
+            ],
+            ignore_index=True,
+        ).drop_duplicates(["row", "column"], keep="last")
+
+        updated_matrix = sparse.csr_matrix(
+            (
+                entries["rating"].to_numpy(dtype=np.float32),
+                (entries["row"].to_numpy(), entries["column"].to_numpy()),
+            ),
+            shape=rating_matrix.shape,
+        )
+        updated_matrix.eliminate_zeros()
+        return updated_matrix, np.unique(new_entries["row"].to_numpy())
+
+    def update_similar_books(
+        self, rating_matrix, changed_rows, neighbour_ids, neighbour_scores
+    ):
+        """Refresh the neighbour table after the given rows of the matrix changed.
+
+        Changed books get their neighbours recomputed exactly. Every other book
+        keeps its neighbours among the unchanged books and re-ranks them against
+        its new similarity with the changed books; a neighbour pushed out of the
+        stored top-k by an earlier change is not recovered until the next full
+        run.
+        """
+        neighbour_ids = np.array(neighbour_ids)
+        neighbour_scores = np.array(neighbour_scores)
+        if len(changed_rows) == 0:
+            return neighbour_ids, neighbour_scores
 
-        pivot_table_df = df_final_collaborative_data.pivot_table(
-            index="Book-Title", columns="User-ID", values="Book-Rating"
+        k = neighbour_ids.shape[1]
+        normalized_matrix = normalize(rating_matrix, norm="l2", axis=1)
+        changed_similarity = (
+            (normalized_matrix[changed_rows] @ normalized_matrix.T.tocsr())
+            .toarray()
+            .astype(np.float32)
         )
-        pivot_table_df.fillna(0, inplace=True)
 
-        similarity_scores_df = cosine_similarity(pivot_table_df)
+        for position, row in enumerate(changed_rows):
+            row_scores = changed_similarity[position : position + 1]
+            row_ids, row_top_scores = self.top_k_neighbours(row_scores, k, offset=row)
+            neighbour_ids[row], neighbour_scores[row] = row_ids[0], row_top_scores[0]
 
-        self.save_dataframe_to_pickle(
-            author_recommendations_df, "pklFiles/author_recommendations.pkl"
+        unchanged_rows = np.setdiff1d(np.arange(rating_matrix.shape[0]), changed_rows)
+        candidate_scores = np.where(
+            np.isin(neighbour_ids[unchanged_rows], changed_rows),
+            -np.inf,
+            neighbour_scores[unchanged_rows],
         )
-        self.save_dataframe_to_pickle(pivot_table_df, "pklFiles/pivot_table.pkl")
-        self.save_dataframe_to_pickle(
-            similarity_scores_df, "pklFiles/similarity_scores.pkl"
+        candidate_scores = np.hstack(
+            [candidate_scores, changed_similarity[:, unchanged_rows].T]
         )
-        self.save_dataframe_to_pickle(self.df_books, "pklFiles/books.pkl")
+        candidate_ids = np.hstack(
+            [
+                neighbour_ids[unchanged_rows],
+                np.broadcast_to(changed_rows, (len(unchanged_rows), len(changed_rows))),
+            ]
+        )
+        top_positions = np.argsort(-candidate_scores, axis=1, kind="stable")[:, :k]
+        neighbour_ids[unchanged_rows] = np.take_along_axis(
+            candidate_ids, top_positions, axis=1
+        )
+        neighbour_scores[unchanged_rows] = np.take_along_axis(
+            candidate_scores, top_positions, axis=1
+        )
+        return neighbour_ids, neighbour_scores
+
+    def update_with_ratings(self, delta_path):
+        """Fold a CSV of new ratings into the current artifact version.
+
+        Only the new ratings are joined. They are merged into the stored joined
+        ratings, and their per-title totals are added to the stored ones, so
+        the books are ranked exactly as in a full run. The title text and the
+        vocabularies of the indexes come from the stage cache and are only
+        renumbered for the new ranking. Only the affected similarity rows are
+        recomputed; books and users outside the collaborative matrix only enter
+        it on the next full preprocess_data run. The catalogue-wide neighbour
+        index and embeddings are kept unless the new ratings change the
+        catalogue matrix. The result is written as a new artifact version.
+
+        The CSV is then copied to the rating deltas directory, which full runs
+        read after the ratings dataset, so folded ratings are never lost.
+        """
+        store = ArtifactStore(self.artifacts_dir)
+        outputs = Pipeline(
+            self.cleaning_stages() + self.vocabulary_stages(),
+            self.stage_cache_dir,
+            self.workers,
+        ).run()
+        self.df_books = outputs["clean_books"]
+        self.df_users = outputs["clean_users"]
+        df_new_ratings, new_title_totals, _ = self.join_ratings(
+            self.df_books, self.df_users, delta_path
+        )
+        if df_new_ratings is None:
+            return None
+
+        df_recommendation_dataset = self.fold_ratings(
+            store.table("books_with_ratings"), df_new_ratings, self.df_books
+        )
+        self.df_recommendation_dataset = df_recommendation_dataset
+        title_totals = store.table("title_totals")
+        title_totals.index = pd.CategoricalIndex(
+            title_totals.pop("Book-Title"),
+            dtype=self.df_books["Book-Title"].dtype,
+            name="Book-Title",
+        )
+        joined_ratings = (
+            df_recommendation_dataset,
+            self.sum_totals([title_totals, new_title_totals]),
+            None,
+        )
+        outputs["join"] = joined_ratings
+        # The rankings only read the totals, so they come out as in a full run
+        self.df_top_books = self.compute_top_books(joined_ratings, self.df_books)
+        author_recommendations_df = self.build_author_recommendations(
+            joined_ratings, self.df_books
+        )
+
+        collaborative_titles = store.array("collaborative_titles").to_list()
+        collaborative_user_ids = np.array(store.array("collaborative_user_ids"))
+        rating_matrix = sparse.csr_matrix(
+            (
+                store.array("rating_matrix.data"),
+                store.array("rating_matrix.indices"),
+                store.array("rating_matrix.indptr"),
+            ),
+            shape=(len(collaborative_titles), len(collaborative_user_ids)),
+        )
+        rating_matrix, changed_rows = self.update_rating_matrix(
+            rating_matrix, collaborative_titles, collaborative_user_ids, df_new_ratings
+        )
+        neighbour_ids, neighbour_scores = self.update_similar_books(
+            rating_matrix,
+            changed_rows,
+            store.array("neighbour_ids"),
+            store.array("neighbour_scores"),
+        )
+        catalogue_matrix = self.build_catalogue_matrix(
+            joined_ratings, self.catalogue_min_book_ratings
+        )
+        indexed_titles = [
+            totals.index[totals["explicit_count"] >= self.catalogue_min_book_ratings]
+            for totals in [title_totals, joined_ratings[1]]
+        ]
+        rated_titles = new_title_totals.index[new_title_totals["explicit_count"] > 0]
+        if (
+            indexed_titles[0].equals(indexed_titles[1])
+            and not rated_titles.isin(indexed_titles[1]).any()
+        ):
+            # The catalogue matrix did not change, and its rows are titles
+            # rather than book ids, so its indexes carry over unchanged
+            ann_index = RandomProjectionIndex.from_store(store)
+            item_embeddings = ItemEmbeddings.from_store(store)
+        else:
+            ann_index = self.build_ann_index(catalogue_matrix)
+            item_embeddings = self.build_item_embeddings(
+                catalogue_matrix, self.embedding_dimensions
+            )
+
+        outputs.update(
+            {
+                "popularity": self.df_top_books,
+                "author_table": author_recommendations_df,
+                "collaborative_matrix": (
+                    rating_matrix,
+                    collaborative_titles,
+                    collaborative_user_ids,
+                ),
+                "similarity": (neighbour_ids, neighbour_scores),
+                "catalogue_matrix": catalogue_matrix,
+                "ann_index": ann_index,
+                "item_embeddings": item_embeddings,
+            }
+        )
+        for stage in self.index_stages():
+            outputs[stage.name] = Pipeline.call(stage, outputs)
+        version = self.save_artifacts(outputs)
+        # Versions sort by creation time, and so do the deltas named after them
+        os.makedirs(self.rating_deltas_dir, exist_ok=True)
+        shutil.copyfile(
+            delta_path, os.path.join(self.rating_deltas_dir, f"{version}.csv")
+        )
+        return version
 
     # Top 50 books
     def get_top_books(self):
-        top_books = pickle.dump(self.df_top_books, open("pklFiles/top_books.pkl", "wb"))
-        return top_books
+        return self.df_top_books[:50]
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the recommendation artifacts.")
+    parser.add_argument(
+        "--delta",
+        help="CSV of new ratings to fold into the current artifact version "
+        "instead of rebuilding everything",
+    )
+    arguments = parser.parse_args()
 
-recommendations_preprocessing = RecommendationsPreprocessing()
-recommendations_preprocessing.preprocess_data()
-recommendations_preprocessing.get_top_books()
+    recommendations_preprocessing = RecommendationsPreprocessing()
+    if arguments.delta:
+        recommendations_preprocessing.update_with_ratings(arguments.delta)
+    else:
+        recommendations_preprocessing.preprocess_data()
@@ -0,0 +1,78 @@
+"""
+
+This file contains a ResultCache class, a bounded and thread-safe LRU cache whose
+entries also expire after a fixed time to live. Its hits, misses, evictions and
+size are reported through a metrics registry, so /metrics shows how well the
+cache works.
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import MetricsRegistry
+
+CACHE_SIZE = 1024
+CACHE_TTL = 600  # seconds
+MISSING = object()
+
+
+class ResultCache:
+    def __init__(
+        self, max_entries=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic, metrics=None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        metrics = metrics or MetricsRegistry()
+        self.hits = metrics.counter(
+            "recommendation_cache_hits_total", "Results answered from the cache."
+        )
+        self.misses = metrics.counter(
+            "recommendation_cache_misses_total",
+            "Results not found in the cache, or found expired.",
+        )
+        self.evictions = metrics.counter(
+            "recommendation_cache_evictions_total",
+            "Results dropped from the full cache, least recently used first.",
+        )
+        self.size = metrics.gauge(
+            "recommendation_cache_entries", "Results held by the cache."
+        )
+        self.size.set(value=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the cached value for key, or MISSING."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits.inc()
+                    return value
+                del self.entries[key]
+                self.size.set(value=len(self.entries))
+            self.misses.inc()
+            return MISSING
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions.inc()
+            self.size.set(value=len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size.set(value=0)
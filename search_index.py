@@ -0,0 +1,273 @@
+"""
+
+This file contains a TitleIndex class that answers case-insensitive substring
+queries over book titles. Titles are normalised (lowercased, runs of whitespace
+collapsed) once when the index is built and split into character n-grams, so a
+query only verifies the few titles that share all of its n-grams instead of
+scanning the whole title column.
+
+The same n-grams resolve free-text input to one book id: an exact title wins,
+then the best rated title containing the input, then the title sharing the
+largest fraction of n-grams with it, which tolerates typos. Inputs shorter than
+an n-gram are looked up in a table of the first title containing every shorter
+substring, since they share no n-gram with any title.
+
+The posting lists are kept as flat arrays (one offsets array and one array of
+book ids) so the index can be written by preprocessing and memory-mapped by the
+server.
+
+"""
+import numpy as np
+
+from artifact_store import slice_offsets
+
+NGRAM_SIZE = 3
+# Share of n-grams (Jaccard) a misspelt query needs with a title to resolve to it
+FUZZY_MIN_SIMILARITY = 0.4
+EMPTY_POSTING = np.empty(0, dtype=np.int32)
+
+
+class TitleIndex:
+    def __init__(
+        self,
+        titles,
+        ngrams=None,
+        offsets=None,
+        book_ids=None,
+        sorted_ids=None,
+        ngram_counts=None,
+        short_queries=None,
+        short_query_ids=None,
+    ):
+        if ngrams is None:
+            titles = [self.normalise(title) for title in titles]
+            ngrams, offsets, book_ids = self.build_postings(titles)
+            sorted_ids = np.argsort(
+                np.array(titles, dtype=object), kind="stable"
+            ).astype(np.int32)
+            ngram_counts = np.array(
+                [len(self.split_ngrams(title)) for title in titles], dtype=np.int32
+            )
+            short_queries, short_query_ids = self.build_short_queries(
+                titles, ngrams, offsets, book_ids, ngram_counts
+            )
+        self.titles = titles
+        self.ngrams = ngrams
+        self.offsets = offsets
+        self.book_ids = book_ids
+        self.sorted_ids = sorted_ids
+        self.ngram_counts = ngram_counts
+        self.ngram_slots = {ngram: slot for slot, ngram in enumerate(ngrams)}
+        self.short_query_ids = dict(zip(short_queries, short_query_ids))
+
+    def __len__(self):
+        return len(self.titles)
+
+    @classmethod
+    def from_store(cls, store, name="title_index"):
+        return cls(
+            store.array(f"{name}.titles"),
+            store.array(f"{name}.ngrams").to_list(),
+            store.array(f"{name}.offsets"),
+            store.array(f"{name}.book_ids"),
+            store.array(f"{name}.sorted_ids"),
+            store.array(f"{name}.ngram_counts"),
+            store.array(f"{name}.short_queries").to_list(),
+            store.array(f"{name}.short_query_ids"),
+        )
+
+    def write(self, writer, name="title_index"):
+        writer.write_strings(f"{name}.titles", self.titles)
+        writer.write_strings(f"{name}.ngrams", self.ngrams)
+        writer.write_array(f"{name}.offsets", self.offsets)
+        writer.write_array(f"{name}.book_ids", self.book_ids)
+        writer.write_array(f"{name}.sorted_ids", self.sorted_ids)
+        writer.write_array(f"{name}.ngram_counts", self.ngram_counts)
+        writer.write_strings(f"{name}.short_queries", list(self.short_query_ids))
+        writer.write_array(
+            f"{name}.short_query_ids",
+            np.fromiter(self.short_query_ids.values(), dtype=np.int32),
+        )
+
+    @staticmethod
+    def normalise(text):
+        return " ".join(str(text).lower().split())
+
+    @staticmethod
+    def split_ngrams(text):
+        return {
+            text[position : position + NGRAM_SIZE]
+            for position in range(len(text) - NGRAM_SIZE + 1)
+        }
+
+    def build_postings(self, titles):
+        """Map every n-gram to the sorted ids of the titles containing it."""
+        postings = {}
+        for book_id, title in enumerate(titles):
+            for ngram in self.split_ngrams(title):
+                postings.setdefault(ngram, []).append(book_id)
+
+        ngrams = sorted(postings)
+        offsets = slice_offsets([len(postings[ngram]) for ngram in ngrams])
+        book_ids = np.fromiter(
+            (book_id for ngram in ngrams for book_id in postings[ngram]),
+            dtype=np.int32,
+            count=offsets[-1],
+        )
+        return ngrams, offsets, book_ids
+
+    @staticmethod
+    def build_short_queries(titles, ngrams, offsets, book_ids, ngram_counts):
+        """Map every substring shorter than an n-gram to the first title containing it.
+
+        A title with an n-gram contains a short substring exactly when one of
+        its n-grams does, so the first title containing the substring is the
+        first one in the postings of those n-grams; shorter titles are
+        checked directly.
+        """
+        first_ids = {}
+        posting_ids = [
+            (ngram, int(book_ids[start]))
+            for ngram, start in zip(ngrams, offsets[:-1].tolist())
+        ]
+        short_ids = np.flatnonzero(ngram_counts == 0).tolist()
+        for text, book_id in posting_ids + [(titles[i], i) for i in short_ids]:
+            for length in range(1, min(NGRAM_SIZE, len(text) + 1)):
+                for position in range(len(text) - length + 1):
+                    substring = text[position : position + length]
+                    if first_ids.get(substring, book_id) >= book_id:
+                        first_ids[substring] = book_id
+        first_ids = dict(sorted(first_ids.items()))
+        return list(first_ids), np.fromiter(first_ids.values(), dtype=np.int32)
+
+    def select(self, title_ids):
+        """Return the index of the titles at ``title_ids``, in that order.
+
+        Title ``title_ids[i]`` gets id i. Only the stored postings are renumbered
+        and reordered, so a ranking of titles indexed once is cheap to apply.
+        """
+        title_ids = np.asarray(title_ids, dtype=np.int64)
+        new_ids = np.full(len(self.titles), -1, dtype=np.int64)
+        new_ids[title_ids] = np.arange(len(title_ids))
+        titles = [self.titles[title_id] for title_id in title_ids.tolist()]
+
+        # Postings are sorted by n-gram, then by new id, as one integer key
+        slots = np.repeat(np.arange(len(self.ngrams)), np.diff(self.offsets))
+        posting_ids = new_ids[self.book_ids]
+        is_selected = posting_ids >= 0
+        posting_keys = np.sort(
+            slots[is_selected] * len(titles) + posting_ids[is_selected]
+        )
+        counts = np.bincount(
+            posting_keys // max(len(titles), 1), minlength=len(self.ngrams)
+        )
+        present = np.flatnonzero(counts)
+        ngrams = [self.ngrams[slot] for slot in present.tolist()]
+        offsets = slice_offsets(counts[present])
+        book_ids = (posting_keys % max(len(titles), 1)).astype(np.int32)
+        ngram_counts = self.ngram_counts[title_ids]
+
+        # Equal titles keep their relative order, so only the ranks of the
+        # distinct titles in the stored order are needed
+        ordered_titles = np.array(
+            [self.titles[title_id] for title_id in self.sorted_ids], dtype=object
+        )
+        title_ranks = np.empty(len(self.titles), dtype=np.int64)
+        title_ranks[self.sorted_ids] = np.cumsum(
+            np.append(True, ordered_titles[1:] != ordered_titles[:-1])
+        )
+        sorted_ids = np.argsort(title_ranks[title_ids], kind="stable").astype(np.int32)
+
+        short_queries, short_query_ids = self.build_short_queries(
+            titles, ngrams, offsets, book_ids, ngram_counts
+        )
+        return TitleIndex(
+            titles,
+            ngrams,
+            offsets,
+            book_ids,
+            sorted_ids,
+            ngram_counts,
+            short_queries,
+            short_query_ids,
+        )
+
+    def posting(self, ngram):
+        slot = self.ngram_slots.get(ngram)
+        if slot is None:
+            return EMPTY_POSTING
+        return self.book_ids[self.offsets[slot] : self.offsets[slot + 1]]
+
+    def candidates(self, query):
+        ngrams = self.split_ngrams(query)
+        if not ngrams:
+            # Queries shorter than one n-gram can only be checked directly.
+            return range(len(self.titles))
+
+        posting_lists = sorted((self.posting(ngram) for ngram in ngrams), key=len)
+        candidate_ids = posting_lists[0]
+        for posting in posting_lists[1:]:
+            if candidate_ids.size == 0:
+                break
+            candidate_ids = np.intersect1d(candidate_ids, posting, assume_unique=True)
+        return candidate_ids
+
+    def search(self, query, limit=None):
+        """Return ids of titles containing the query, in ascending id order."""
+        query = self.normalise(query)
+        matches = []
+        for book_id in self.candidates(query):
+            if query in self.titles[book_id]:
+                matches.append(int(book_id))
+                if limit is not None and len(matches) >= limit:
+                    break
+        return matches
+
+    def first_match(self, query):
+        query = self.normalise(query)
+        if len(query) < NGRAM_SIZE:
+            return self.short_query_ids.get(query)
+        matches = self.search(query, limit=1)
+        return matches[0] if matches else None
+
+    def exact_match(self, query):
+        """Return the lowest id whose title equals the query, or None."""
+        query = self.normalise(query)
+        low, high = 0, len(self.sorted_ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.titles[self.sorted_ids[middle]] < query:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.sorted_ids) and self.titles[self.sorted_ids[low]] == query:
+            return int(self.sorted_ids[low])
+        return None
+
+    def fuzzy_match(self, query, min_similarity=FUZZY_MIN_SIMILARITY):
+        """Return the id of the title sharing the most n-grams with the query.
+
+        Titles are scored by the Jaccard similarity of their n-gram sets; ties
+        go to the lowest id. Returns None below ``min_similarity``.
+        """
+        ngrams = self.split_ngrams(self.normalise(query))
+        posting_lists = [self.posting(ngram) for ngram in ngrams]
+        if not any(len(posting) for posting in posting_lists):
+            return None
+
+        shared = np.bincount(np.concatenate(posting_lists), minlength=len(self))
+        similarity = shared / (len(ngrams) + self.ngram_counts - shared)
+        book_id = int(np.argmax(similarity))
+        if similarity[book_id] < min_similarity:
+            return None
+        return book_id
+
+    def resolve(self, query):
+        """Map free-text input to one book id: exact, then substring, then fuzzy."""
+        if not self.normalise(query):
+            return None
+        for match in (self.exact_match, self.first_match, self.fuzzy_match):
+            book_id = match(query)
+            if book_id is not None:
+                return book_id
+        return None
@@ -0,0 +1,157 @@
+"""
+
+This file contains a SnapshotManager class that lets the web server switch
+artifact versions without a restart. Every artifact version is served by its
+own RecommendationSystem, the snapshot. A new version is loaded and warmed up
+next to the live snapshot and then swapped in with a single reference
+assignment; a request reads the live snapshot once and finishes on it even if
+a swap happens meanwhile.
+
+The previous snapshot stays loaded, so rolling back is another swap; older
+ones are freed once the requests still using them finish. Workers can watch
+the CURRENT file of the artifacts directory and follow it, so publishing or
+rolling back a version there reaches every worker. A manager created before a
+pre-forking server forks its workers restarts its threads in every child.
+
+"""
+import os
+import threading
+import weakref
+
+from artifact_store import ARTIFACTS_DIR, current_version, publish_version
+from metrics import MetricsRegistry
+
+POLL_INTERVAL = 5.0
+
+
+def call_while_alive(method):
+    """Wrap a bound method in a function that holds only a weak reference."""
+    reference = weakref.WeakMethod(method)
+
+    def call():
+        method = reference()
+        if method is not None:
+            method()
+
+    return call
+
+
+class SnapshotManager:
+    def __init__(self, factory, artifacts_dir=ARTIFACTS_DIR, metrics=None):
+        """``factory`` returns a new, unloaded RecommendationSystem."""
+        self.factory = factory
+        self.artifacts_dir = artifacts_dir
+        self.current = None
+        self.previous = None
+        self.failed_version = None
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.interval = POLL_INTERVAL
+        self.stopped = threading.Event()
+        metrics = metrics or MetricsRegistry()
+        self.swaps = metrics.counter(
+            "recommendation_snapshot_swaps_total",
+            "Artifact snapshot changes of this worker by outcome.",
+            ["outcome"],
+        )
+        # Fork hooks cannot be unregistered, so the hook must not keep the
+        # manager alive
+        os.register_at_fork(after_in_child=call_while_alive(self.after_fork))
+
+    def swap(self, snapshot):
+        """Make snapshot live and keep the live one for a rollback.
+
+        The snapshot dropped is not closed: requests may still be running on
+        it, and it is garbage-collected, threads included, once they finish.
+        """
+        self.previous, self.current = self.current, snapshot
+
+    def load(self, version=None, preload=True):
+        """Load, warm up and swap in a version, by default the published one.
+
+        Without ``preload`` the artifacts of the new snapshot are loaded on
+        first use instead, which only suits a server that is not serving yet.
+        Returns the live version, which is unchanged if the version could not
+        be loaded.
+        """
+        with self.lock:
+            if version is None:
+                try:
+                    version = current_version(self.artifacts_dir)
+                except FileNotFoundError:
+                    version = None
+            if self.current is not None and version is not None:
+                if self.current.artifact_version == version:
+                    return version
+                if self.previous and self.previous.artifact_version == version:
+                    self.swap(self.previous)
+                    self.swaps.inc("rollback")
+                    return version
+
+            snapshot = self.factory()
+            loaded = False
+            try:
+                snapshot.load_data(version, preload)
+                if preload:
+                    snapshot.warm_up()
+                loaded = snapshot.artifact_version is not None
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading artifact version {version}: {e}")
+            if not loaded and self.current is not None:
+                # Not retried until another version is published
+                self.failed_version = version
+                snapshot.close()
+                self.swaps.inc("failed")
+                return self.current.artifact_version
+
+            self.swap(snapshot)
+            self.swaps.inc("loaded")
+            return snapshot.artifact_version
+
+    def rollback(self):
+        """Swap the previous snapshot back in and publish its version.
+
+        Publishing keeps restarted and watching workers on the same version.
+        Returns the live version, or None if there is nothing to roll back to.
+        """
+        with self.lock:
+            if self.previous is None or self.previous.artifact_version is None:
+                return None
+            self.swap(self.previous)
+            self.swaps.inc("rollback")
+            publish_version(self.artifacts_dir, self.current.artifact_version)
+            return self.current.artifact_version
+
+    def watch(self, interval=POLL_INTERVAL):
+        """Follow the published version from a background thread."""
+        if self.watcher is not None:
+            return
+        self.interval = interval
+        self.watcher = threading.Thread(
+            target=self.follow, args=(interval,), name="snapshot-watcher", daemon=True
+        )
+        self.watcher.start()
+
+    def follow(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                published = current_version(self.artifacts_dir)
+            except OSError as e:
+                print(f"Error reading the published artifact version: {e}")
+                continue
+            if published not in (self.current.artifact_version, self.failed_version):
+                self.load(published)
+
+    def stop(self):
+        self.stopped.set()
+
+    def after_fork(self):
+        """Recreate the locks and threads a forked child did not inherit."""
+        self.lock = threading.Lock()
+        for snapshot in (self.current, self.previous):
+            if snapshot is not None:
+                snapshot.restart_executor()
+        if self.watcher is not None and not self.stopped.is_set():
+            self.stopped = threading.Event()
+            self.watcher = None
+            self.watch(self.interval)
@@ -0,0 +1,219 @@
+"""
+
+This file contains a seeded generator of datasets shaped like the Book-Crossing
+files in Dataset/ (Books.csv, Ratings.csv and Users.csv), so the preprocessing
+step and the web server can be run and benchmarked without the original data.
+Popularity and user activity follow power laws, most ratings are implicit
+zeros, and the same kinds of dirty values as in the real files are included:
+missing authors and publishers, invalid years, incomplete locations,
+implausible ages and ratings of unknown ISBNs.
+
+The output directory is required and existing files are never overwritten,
+so generate into a scratch directory, for example:
+    python synthetic_dataset.py /tmp/synthetic
+
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+BOOKS_COUNT = 20_000
+USERS_COUNT = 10_000
+RATINGS_COUNT = 500_000
+TITLE_WORDS = [
+    "harry", "potter", "secret", "garden", "lord", "rings", "night", "dark",
+    "love", "war", "peace", "tale", "city", "river", "stone", "fire", "king",
+    "queen", "summer", "winter", "house", "shadow", "island", "letters",
+    "murder", "heart", "girl", "time", "road", "storm", "gold", "angel",
+]  # fmt: skip
+COUNTRIES = {
+    "usa": ["california", "texas", "new york", "florida", "washington", "illinois"],
+    "canada": ["ontario", "quebec", "british columbia", "alberta"],
+    "united kingdom": ["england", "scotland", "wales"],
+    "germany": ["bayern", "berlin", "hessen", "hamburg"],
+    "spain": ["madrid", "barcelona", "valencia"],
+    "australia": ["new south wales", "victoria", "queensland"],
+    "france": ["ile de france", "provence", "bretagne"],
+    "italy": ["lazio", "lombardia", "toscana"],
+}
+TITLE_SYLLABLES = ["ka", "lo", "mi", "ren", "sha", "tor", "vel", "an", "dre", "is"]
+IMPLICIT_RATING_SHARE = 0.62
+# Explicit ratings lean towards the top of the scale, as in Book-Crossing
+RATING_WEIGHTS = np.array([1, 1, 2, 3, 9, 8, 15, 23, 18, 20]) / 100
+UNKNOWN_ISBN_SHARE = 0.03
+
+
+class SyntheticDataset:
+    def __init__(
+        self,
+        books_count=BOOKS_COUNT,
+        users_count=USERS_COUNT,
+        ratings_count=RATINGS_COUNT,
+        seed=0,
+    ):
+        self.books_count = books_count
+        self.users_count = users_count
+        self.ratings_count = ratings_count
+        self.seed = seed
+
+    @staticmethod
+    def isbn_numbers(numbers):
+        """Format numbers as ISBN-10 strings with a valid check character."""
+        digits = (numbers[:, None] // 10 ** np.arange(8, -1, -1)) % 10
+        check = (11 - (digits * np.arange(10, 1, -1)).sum(axis=1) % 11) % 11
+        check_characters = np.where(check == 10, "X", check.astype(str))
+        return np.char.add(
+            np.char.zfill(numbers.astype(str), 9), check_characters.astype(str)
+        )
+
+    @staticmethod
+    def title_vocabulary(rng):
+        """Common title words followed by made-up names, most frequent first."""
+        names = {
+            "".join(rng.choice(TITLE_SYLLABLES, rng.integers(2, 4)))
+            for _ in range(5000)
+        }
+        return np.array(TITLE_WORDS + sorted(names))
+
+    def books(self, rng):
+        count = self.books_count
+        numbers = rng.choice(10**9, size=count, replace=False)
+        vocabulary = self.title_vocabulary(rng)
+        word_counts = rng.integers(2, 6, count)
+        word_frequencies = 1 / np.arange(1, len(vocabulary) + 1) ** 0.6
+        words = rng.choice(
+            vocabulary, size=(count, 5), p=word_frequencies / word_frequencies.sum()
+        )
+        titles = np.array(
+            [" ".join(row[:length]).title() for row, length in zip(words, word_counts)],
+            dtype=object,
+        )
+        authors = rng.integers(0, max(count // 6, 1), count)
+        # About one book in twenty is another edition of an earlier title
+        editions = np.flatnonzero(rng.random(count) < 0.05)
+        editions = editions[editions > 0]
+        originals = rng.integers(0, editions)
+        titles[editions] = titles[originals]
+        authors[editions] = authors[originals]
+
+        df_books = pd.DataFrame(
+            {
+                "ISBN": self.isbn_numbers(numbers),
+                "Book-Title": titles,
+                "Book-Author": np.char.add("Author ", authors.astype(str)),
+                "Year-Of-Publication": rng.integers(1950, 2005, count),
+                "Publisher": np.char.add(
+                    "Publisher ", rng.zipf(1.5, count).clip(max=2000).astype(str)
+                ),
+            }
+        )
+        df_books["Book-Author"] = df_books["Book-Author"].astype(object)
+        df_books["Publisher"] = df_books["Publisher"].astype(object)
+        df_books.loc[rng.random(count) < 0.001, "Book-Author"] = None
+        df_books.loc[rng.random(count) < 0.001, "Publisher"] = None
+        df_books.loc[rng.random(count) < 0.01, "Year-Of-Publication"] = 0
+        df_books.loc[rng.random(count) < 0.001, "Year-Of-Publication"] = 2030
+
+        for size in ["S", "M", "L"]:
+            df_books[f"Image-URL-{size}"] = (
+                "http://images.example.com/images/P/"
+                + df_books["ISBN"]
+                + f".01.THUMBZZZ.{size}.jpg"
+            )
+        return df_books
+
+    def users(self, rng):
+        count = self.users_count
+        places = [
+            (f"{state} city {number}", state, country)
+            for country, states in COUNTRIES.items()
+            for state in states
+            for number in range(4)
+        ]
+        place_popularity = 1 / np.arange(1, len(places) + 1)
+        places = [
+            places[position]
+            for position in rng.choice(
+                len(places), count, p=place_popularity / place_popularity.sum()
+            )
+        ]
+        locations = np.array([", ".join(place) for place in places], dtype=object)
+        incomplete = rng.random(count)
+        locations[incomplete < 0.02] = [
+            f"{city}, n/a, {country}"
+            for city, _, country in np.array(places, dtype=object)[incomplete < 0.02]
+        ]
+        locations[(incomplete >= 0.02) & (incomplete < 0.03)] = "n/a, n/a, n/a"
+
+        ages = rng.normal(35, 13, count).round().clip(5, 95)
+        ages[rng.random(count) < 0.4] = np.nan
+        implausible = rng.random(count) < 0.01
+        ages[implausible] = rng.choice([0, 1, 120, 200], implausible.sum())
+        return pd.DataFrame(
+            {
+                "User-ID": np.arange(1, count + 1),
+                "Location": locations,
+                "Age": ages,
+            }
+        )
+
+    def ratings(self, rng, isbns):
+        """Draw ratings_count ratings; repeated user and book pairs are dropped."""
+        count = self.ratings_count
+        book_popularity = 1 / np.arange(1, len(isbns) + 1) ** 0.8
+        books = rng.permutation(len(isbns))[
+            rng.choice(len(isbns), count, p=book_popularity / book_popularity.sum())
+        ]
+        user_activity = 1 / np.arange(1, self.users_count + 1) ** 0.9
+        users = rng.permutation(self.users_count)[
+            rng.choice(self.users_count, count, p=user_activity / user_activity.sum())
+        ]
+        ratings = rng.choice(np.arange(1, 11), count, p=RATING_WEIGHTS)
+        ratings[rng.random(count) < IMPLICIT_RATING_SHARE] = 0
+
+        isbns = np.asarray(isbns)[books]
+        unknown = rng.random(count) < UNKNOWN_ISBN_SHARE
+        isbns[unknown] = self.isbn_numbers(rng.choice(10**9, unknown.sum()))
+        return pd.DataFrame(
+            {"User-ID": users + 1, "ISBN": isbns, "Book-Rating": ratings}
+        ).drop_duplicates(["User-ID", "ISBN"])
+
+    def write(self, directory):
+        """Write Books.csv, Ratings.csv and Users.csv into a new directory or
+        one without them; existing files are never overwritten."""
+        paths = [
+            os.path.join(directory, name)
+            for name in ("Books.csv", "Ratings.csv", "Users.csv")
+        ]
+        existing = [path for path in paths if os.path.exists(path)]
+        if existing:
+            raise FileExistsError(f"Refusing to overwrite {', '.join(existing)}")
+        rng = np.random.default_rng(self.seed)
+        os.makedirs(directory, exist_ok=True)
+        df_books = self.books(rng)
+        df_books.to_csv(os.path.join(directory, "Books.csv"), index=False)
+        self.users(rng).to_csv(os.path.join(directory, "Users.csv"), index=False)
+        self.ratings(rng, df_books["ISBN"]).to_csv(
+            os.path.join(directory, "Ratings.csv"), index=False
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset.")
+    parser.add_argument("--books", type=int, default=BOOKS_COUNT)
+    parser.add_argument("--users", type=int, default=USERS_COUNT)
+    parser.add_argument("--ratings", type=int, default=RATINGS_COUNT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "output", help="directory to write into, for example a scratch directory"
+    )
+    arguments = parser.parse_args()
+
+    try:
+        SyntheticDataset(
+            arguments.books, arguments.users, arguments.ratings, arguments.seed
+        ).write(arguments.output)
+    except FileExistsError as e:
+        parser.error(str(e))
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recommendations_preprocessing import RecommendationsPreprocessing  # noqa: E402
+from synthetic_dataset import SyntheticDataset  # noqa: E402
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """A small synthetic dataset in a scratch directory made the working one."""
+    SyntheticDataset(300, 2000, 40_000, seed=1).write(str(tmp_path / "Dataset"))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def preprocessing(dataset):
+    return RecommendationsPreprocessing(
+        min_user_ratings=20,
+        min_book_ratings=5,
+        artifacts_dir=str(dataset / "artifacts"),
+        embedding_dimensions=8,
+        stage_cache_dir=str(dataset / "stage_cache"),
+        workers=1,
+    )
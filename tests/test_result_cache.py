@@ -0,0 +1,55 @@
+from metrics import MetricsRegistry
+from result_cache import MISSING, ResultCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2, ttl=60, clock=FakeClock())
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_the_time_to_live():
+    clock = FakeClock()
+    cache = ResultCache(max_entries=10, ttl=60, clock=clock)
+    cache.put("a", 1)
+    clock.now = 59.0
+    assert cache.get("a") == 1
+    clock.now = 60.0
+    assert cache.get("a") is MISSING
+    assert len(cache) == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResultCache(max_entries=0)
+    cache.put("a", 1)
+    assert cache.get("a") is MISSING
+
+
+def test_counters_are_reported_through_the_registry():
+    metrics = MetricsRegistry()
+    cache = ResultCache(max_entries=1, ttl=60, clock=FakeClock(), metrics=metrics)
+    cache.get("a")
+    cache.put("a", 1)
+    cache.get("a")
+    cache.put("b", 2)
+
+    lines = metrics.render().splitlines()
+    assert "recommendation_cache_hits_total 1" in lines
+    assert "recommendation_cache_misses_total 1" in lines
+    assert "recommendation_cache_evictions_total 1" in lines
+    assert "recommendation_cache_entries 1" in lines
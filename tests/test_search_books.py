@@ -0,0 +1,48 @@
+import pytest
+
+from recommendations import RecommendationSystem
+
+
+@pytest.fixture
+def system(preprocessing):
+    preprocessing.preprocess_data()
+    system = RecommendationSystem(preprocessing.artifacts_dir)
+    system.load_data()
+    return system
+
+
+def names(page):
+    return [book.name for book in page.books]
+
+
+def test_unfiltered_pages_follow_the_catalogue(system):
+    page, total = system.search_books(offset=20, limit=10)
+    assert total == len(system.book_titles)
+    assert names(page) == system.book_titles[20:30]
+
+
+def test_pages_split_the_matches_without_gaps(system):
+    everything, total = system.search_books(year_from=1980, year_to=2000, limit=1000)
+    assert 10 < total < 1000
+    pages = [
+        system.search_books(year_from=1980, year_to=2000, offset=offset, limit=7)
+        for offset in range(0, total, 7)
+    ]
+    assert [name for page, _ in pages for name in names(page)] == names(everything)
+    assert {page_total for _, page_total in pages} == {total}
+
+
+def test_offsets_past_the_matches_give_an_empty_page(system):
+    author = system.book_authors[0]
+    for filters in ({}, {"author": author}, {"year_from": 1980}):
+        _, expected_total = system.search_books(**filters)
+        for offset in (expected_total, 10**18):
+            page, total = system.search_books(offset=offset, **filters)
+            assert names(page) == []
+            assert total == expected_total
+
+
+def test_negative_offsets_start_at_the_first_match(system):
+    first, _ = system.search_books(offset=0)
+    page, _ = system.search_books(offset=-5)
+    assert names(page) == names(first)
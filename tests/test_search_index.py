@@ -0,0 +1,57 @@
+import numpy as np
+
+from search_index import TitleIndex
+
+# Book ids are positions, best rated first
+TITLES = [
+    "The Hobbit",
+    "Harry Potter and the Chamber of Secrets",
+    "Harry Potter",
+    "A Tale of Two Cities",
+]
+
+
+def test_exact_title_wins_over_better_rated_substring_matches():
+    assert TitleIndex(TITLES).resolve("harry potter") == 2
+
+
+def test_substring_resolves_to_the_best_rated_title():
+    index = TitleIndex(TITLES)
+    assert index.resolve("potter") == 1
+    assert index.resolve("two cit") == 3
+
+
+def test_case_and_spacing_are_ignored():
+    assert TitleIndex(TITLES).resolve("  the   HOBBIT ") == 0
+
+
+def test_misspelt_title_resolves_fuzzily():
+    index = TitleIndex(TITLES)
+    assert index.resolve("the hobit") == 0
+    assert index.resolve("a tale of too cities") == 3
+
+
+def test_queries_shorter_than_an_ngram():
+    index = TitleIndex(TITLES)
+    assert index.resolve("ho") == 0
+    assert index.resolve("y") == 1
+    assert index.resolve("q") is None
+
+
+def test_unmatched_and_blank_queries_resolve_to_nothing():
+    index = TitleIndex(TITLES)
+    assert index.resolve("zzzz zzzz") is None
+    assert index.resolve("   ") is None
+
+
+def test_selected_index_matches_a_direct_build():
+    title_ids = [3, 0, 2]
+    selected = TitleIndex(TITLES).select(title_ids)
+    built = TitleIndex([TITLES[title_id] for title_id in title_ids])
+
+    assert selected.titles == built.titles
+    assert list(selected.ngrams) == list(built.ngrams)
+    for name in ("offsets", "book_ids", "sorted_ids", "ngram_counts"):
+        np.testing.assert_array_equal(getattr(selected, name), getattr(built, name))
+    for query in ("harry", "the hobbit", "tale", "ho", "y"):
+        assert selected.resolve(query) == built.resolve(query)
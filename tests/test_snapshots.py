@@ -0,0 +1,75 @@
+from artifact_store import ArtifactWriter, current_version
+from snapshots import SnapshotManager
+
+
+class FakeSnapshot:
+    """Stands in for a RecommendationSystem; "broken" versions fail to load."""
+
+    def __init__(self):
+        self.artifact_version = None
+        self.closed = False
+
+    def load_data(self, version, preload):
+        if version == "broken":
+            raise OSError("unreadable manifest")
+        self.artifact_version = version
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def restart_executor(self):
+        pass
+
+
+def publish(root, version):
+    ArtifactWriter(str(root), version).commit()
+
+
+def manager_with_factory(root):
+    snapshots = []
+
+    def factory():
+        snapshots.append(FakeSnapshot())
+        return snapshots[-1]
+
+    return SnapshotManager(factory, str(root)), snapshots
+
+
+def test_rollback_restores_and_publishes_the_previous_snapshot(tmp_path):
+    manager, snapshots = manager_with_factory(tmp_path)
+    publish(tmp_path, "v1")
+    assert manager.load() == "v1"
+    publish(tmp_path, "v2")
+    assert manager.load() == "v2"
+
+    assert manager.rollback() == "v1"
+    assert manager.current is snapshots[0]
+    assert current_version(str(tmp_path)) == "v1"
+    # Following the published version again reuses the loaded snapshots
+    assert manager.load() == "v1"
+    assert manager.load("v2") == "v2"
+    assert manager.current is snapshots[1]
+    assert len(snapshots) == 2
+
+
+def test_rollback_without_a_previous_snapshot_does_nothing(tmp_path):
+    manager, _ = manager_with_factory(tmp_path)
+    assert manager.rollback() is None
+    publish(tmp_path, "v1")
+    manager.load()
+    assert manager.rollback() is None
+    assert manager.current.artifact_version == "v1"
+
+
+def test_version_failing_to_load_leaves_the_live_snapshot(tmp_path):
+    manager, snapshots = manager_with_factory(tmp_path)
+    publish(tmp_path, "v1")
+    manager.load()
+
+    assert manager.load("broken") == "v1"
+    assert manager.current is snapshots[0]
+    assert manager.failed_version == "broken"
+    assert snapshots[1].closed